@@ -0,0 +1,88 @@
+//
+// ApktoolServer.java: long-lived apktool process for apktoolpool.py
+//
+// Reads requests from stdin, one per line, and answers each with one line on
+// stdout:
+//   ping                   ->  pong
+//   d <TAB> apk <TAB> dir [<TAB> option]...  ->  ok | error <TAB> message
+// A `d` request decodes like `apktool d -f -s [option]... -o dir apk`, where
+// the options may be --no-res and --no-assets.
+//
+// Needs apktool 2.9 or later and Java 11 or later (for the source launcher):
+//   java -cp apktool.jar ApktoolServer.java
+//
+
+import brut.androlib.ApkDecoder;
+import brut.androlib.Config;
+import brut.directory.ExtFile;
+import java.io.BufferedReader;
+import java.io.File;
+import java.io.FileDescriptor;
+import java.io.FileOutputStream;
+import java.io.InputStreamReader;
+import java.io.PrintStream;
+import java.lang.reflect.Constructor;
+import java.util.Arrays;
+
+public class ApktoolServer {
+
+    public static void main(String[] args) throws Exception {
+
+        // Keep the output of apktool off the replies
+        PrintStream out = new PrintStream(
+                new FileOutputStream(FileDescriptor.out), true, "UTF-8");
+        System.setOut(System.err);
+
+        BufferedReader in = new BufferedReader(
+                new InputStreamReader(System.in, "UTF-8"));
+        String line;
+        while ((line = in.readLine()) != null) {
+            String[] fields = line.split("\t");
+            if (fields[0].equals("ping")) {
+                out.println("pong");
+            } else if (fields[0].equals("d") && fields.length >= 3) {
+                try {
+                    decode(fields[1], fields[2],
+                            Arrays.copyOfRange(fields, 3, fields.length));
+                    out.println("ok");
+                } catch (Throwable e) {
+                    out.println("error\t" + String.valueOf(e)
+                            .replace('\n', ' ').replace('\t', ' '));
+                }
+            } else {
+                out.println("error\tbad request");
+            }
+        }
+    }
+
+    // Decode apk to dir without sources and with options, replacing dir
+    static void decode(String apk, String dir, String[] options)
+            throws Exception {
+
+        Config config = Config.getDefaultConfig();
+        config.forceDelete = true;
+        config.setDecodeSources(Config.DECODE_SOURCES_NONE);
+        for (String option : options) {
+            if (option.equals("--no-res")) {
+                config.setDecodeResources(Config.DECODE_RESOURCES_NONE);
+            } else if (option.equals("--no-assets")) {
+                config.setDecodeAssets(Config.DECODE_ASSETS_NONE);
+            } else {
+                throw new IllegalArgumentException("unknown option " + option);
+            }
+        }
+
+        // The arguments of the constructor were swapped in apktool 2.10
+        ApkDecoder decoder;
+        try {
+            Constructor<ApkDecoder> c = ApkDecoder.class.getConstructor(
+                    Config.class, ExtFile.class);
+            decoder = c.newInstance(config, new ExtFile(apk));
+        } catch (NoSuchMethodException e) {
+            Constructor<ApkDecoder> c = ApkDecoder.class.getConstructor(
+                    ExtFile.class, Config.class);
+            decoder = c.newInstance(new ExtFile(apk), config);
+        }
+        decoder.decode(new File(dir));
+    }
+}
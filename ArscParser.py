@@ -0,0 +1,248 @@
+#!/usr/bin/python3
+#
+# ArscParser.py: Object to parse compiled resource tables (resources.arsc)
+#
+# For documentation on the resource table format, see:
+# https://android.googlesource.com/platform/frameworks/base/+/master/libs/androidfw/include/androidfw/ResourceTypes.h
+#
+
+from message import *
+import struct
+
+
+# Resource chunk types
+RES_STRING_POOL_TYPE = 0x0001
+RES_TABLE_TYPE = 0x0002
+RES_TABLE_PACKAGE_TYPE = 0x0200
+RES_TABLE_TYPE_TYPE = 0x0201
+
+# Resource value type for strings
+TYPE_STRING = 0x03
+
+
+# Object for storing a chunk header (ResChunk_header)
+class ResChunk:
+
+    def __init__(self, data, offset):
+
+        self.offset = offset
+        (
+            self.type,
+            self.header_size,
+            self.size
+        ) = struct.unpack_from('<HHI', data, offset)
+
+    # Offset of the chunk body
+    @property
+    def body(self):
+
+        return self.offset + self.header_size
+
+    # Offset of the next chunk
+    @property
+    def end(self):
+
+        return self.offset + self.size
+
+
+# Object for string pools (ResStringPool_header)
+class ResStringPool:
+
+    UTF8_FLAG = 1 << 8
+
+    def __init__(self, data, chunk):
+
+        (
+            self.string_count,
+            self.style_count,
+            self.flags,
+            self.strings_start,
+            self.styles_start
+        ) = struct.unpack_from('<IIIII', data, chunk.offset + 8)
+
+        self.utf8 = (self.flags & ResStringPool.UTF8_FLAG) != 0
+        self.offsets = struct.unpack_from('<%dI' % (self.string_count), data,
+                chunk.body)
+
+        self.data = data
+        self.start = chunk.offset + self.strings_start
+
+    # Number of strings in the pool
+    def __len__(self):
+
+        return self.string_count
+
+    # Return string idx as UTF-8 encoded bytes
+    def get(self, idx):
+
+        offset = self.start + self.offsets[idx]
+
+        if self.utf8:
+            # Skip UTF-16 length, then read UTF-8 byte length
+            offset += 2 if self.data[offset] & 0x80 else 1
+            size = self.data[offset]
+            if size & 0x80:
+                size = ((size & 0x7f) << 8) | self.data[offset + 1]
+                offset += 1
+            offset += 1
+            return bytes(self.data[offset:offset+size])
+
+        size, = struct.unpack_from('<H', self.data, offset)
+        offset += 2
+        if size & 0x8000:
+            low, = struct.unpack_from('<H', self.data, offset)
+            size = ((size & 0x7fff) << 16) | low
+            offset += 2
+        string = bytes(self.data[offset:offset+2*size]).decode('utf-16-le',
+                errors='replace')
+        return string.encode('utf-8', errors='replace')
+
+
+# Object for type chunks (ResTable_type)
+class ResTableType:
+
+    FLAG_SPARSE = 0x01
+    FLAG_OFFSET16 = 0x02
+    NO_ENTRY = 0xffffffff
+
+    # Entry flags
+    FLAG_COMPLEX = 0x0001
+    FLAG_COMPACT = 0x0008
+
+    def __init__(self, data, chunk):
+
+        (
+            self.id,
+            self.flags,
+            self.entry_count,
+            self.entries_start,
+            config_size
+        ) = struct.unpack_from('<BBxxIII', data, chunk.offset + 8)
+
+        # The default configuration is all zeros after its size field
+        config_off = chunk.offset + 20
+        self.default = not any(data[config_off+4:config_off+config_size])
+
+        self.data = data
+        self.chunk = chunk
+
+    # Yield (entry index, string pool index) of every string value
+    def strings(self):
+
+        data = self.data
+        offsets_off = self.chunk.body
+        entries_off = self.chunk.offset + self.entries_start
+
+        if self.flags & ResTableType.FLAG_SPARSE:
+            pairs = struct.unpack_from('<%dH' % (2*self.entry_count), data,
+                    offsets_off)
+            entries = [ (pairs[i], pairs[i+1]*4) for i in
+                    range(0, len(pairs), 2) ]
+        elif self.flags & ResTableType.FLAG_OFFSET16:
+            offsets = struct.unpack_from('<%dH' % (self.entry_count), data,
+                    offsets_off)
+            entries = [ (i, o*4) for i, o in enumerate(offsets) if o != 0xffff ]
+        else:
+            offsets = struct.unpack_from('<%dI' % (self.entry_count), data,
+                    offsets_off)
+            entries = [ (i, o) for i, o in enumerate(offsets) if
+                    o != ResTableType.NO_ENTRY ]
+
+        for idx, offset in entries:
+            offset += entries_off
+            size, flags = struct.unpack_from('<HH', data, offset)
+
+            if flags & ResTableType.FLAG_COMPACT:
+                # Compact entries store the value type in the high flag byte
+                if (flags >> 8) == TYPE_STRING:
+                    value, = struct.unpack_from('<I', data, offset + 4)
+                    yield idx, value
+            elif not flags & ResTableType.FLAG_COMPLEX:
+                # Skip entry header (size, flags, key) and Res_value size, res0
+                data_type, value = struct.unpack_from('<BI', data, offset + 11)
+                if data_type == TYPE_STRING:
+                    yield idx, value
+
+
+# Object to parse resources.arsc files
+class ArscParser:
+
+    def __init__(self, data, file_path='resources.arsc'):
+
+        self.FILE_PATH = file_path
+        self.pool = None        # Global (value) string pool
+        self.strings = []       # Default configuration `string` resources
+
+        try:
+            self.readTable(memoryview(data))
+        except struct.error:
+            error('ArscParser', 'truncated resource table in %s' %
+                    (self.FILE_PATH))
+        except (IndexError, UnicodeDecodeError) as e:
+            error('ArscParser', 'malformed resource table in %s: %s' %
+                    (self.FILE_PATH, e))
+
+    # Parse resource table
+    def readTable(self, data):
+
+        table = ResChunk(data, 0)
+        if table.type != RES_TABLE_TYPE:
+            error('readTable', 'invalid resource table header for %s' %
+                    (self.FILE_PATH))
+            return
+
+        offset = table.body
+        while offset < min(table.end, len(data)):
+            chunk = ResChunk(data, offset)
+            if chunk.size == 0:
+                break
+            if chunk.type == RES_STRING_POOL_TYPE and self.pool is None:
+                self.pool = ResStringPool(data, chunk)
+            elif chunk.type == RES_TABLE_PACKAGE_TYPE:
+                if self.pool is None:
+                    error('readTable', 'package before string pool in %s' %
+                            (self.FILE_PATH))
+                    break
+                self.readPackage(data, chunk)
+            offset = chunk.end
+
+        verb('readTable', 'found %d string resources in %s' %
+                (len(self.strings), self.FILE_PATH))
+
+    # Parse resource package and collect the values of its `string` type
+    def readPackage(self, data, package):
+
+        type_strings, = struct.unpack_from('<I', data, package.offset + 268)
+        type_pool = ResStringPool(data, ResChunk(data,
+            package.offset + type_strings))
+
+        offset = package.body
+        while offset < package.end:
+            chunk = ResChunk(data, offset)
+            if chunk.size == 0:
+                break
+            if chunk.type == RES_TABLE_TYPE_TYPE:
+                res_type = ResTableType(data, chunk)
+                if (res_type.default and
+                        type_pool.get(res_type.id - 1) == b'string'):
+                    self.strings += [ self.pool.get(value) for idx, value in
+                            res_type.strings() ]
+            offset = chunk.end
+
+
+if __name__ == '__main__':
+
+    import sys
+    import settings
+
+    settings.VERBOSE = True
+
+    if len(sys.argv) < 2:
+        error(sys.argv[0], '%s <resources.arsc>' % (sys.argv[0]), fatal=True,
+                pre='usage')
+
+    with open(sys.argv[1], 'rb') as arsc_file:
+        arsc = ArscParser(arsc_file.read(), sys.argv[1])
+
+    for s in arsc.strings:
+        print(s)
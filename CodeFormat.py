@@ -9,6 +9,7 @@
 
 # TODO update CPI format classes to identify which constant pool is used 
 
+import array
 from message import *
 import struct
 
@@ -722,6 +723,99 @@ for i in range(0x3e, 0x44): _push(i)
 for i in range(0x79, 0x7b): _push(i)
 for i in range(0xe3, 0xfa): _push(i)
 
+# Build the field layout of a sequence of formats starting at bit offset idx
+# Each field is (format, first code unit, number of code units, shift, mask)
+# NOTE zero formats get a zero mask since Zero objects always have value 0
+def _layout(formats, idx):
+    fields = []
+    for fmt in formats:
+        unit = idx >> 4
+        n_units = ((idx + fmt.size - 1) >> 4) - unit + 1
+        mask = 0 if issubclass(fmt, Zero) else (1 << fmt.size) - 1
+        fields.append( (fmt, unit, n_units, idx & 0xf, mask) )
+        idx += fmt.size
+    return tuple(fields), idx
+
+# Build the decoding table entry for an opcode
+# Returns (var_spec, layouts) where var_spec is None for fixed-length formats
+# and (unit, shift, mask) of the variable-length argument otherwise. layouts
+# holds one (fields, n_units, valid) entry per value of the variable argument.
+def _tableEntry(formats):
+    var_fmt = [fmt for fmt in formats if fmt.var_length]
+    if not var_fmt:
+        fields, idx = _layout(formats, 8)
+        return None, ((fields, idx >> 4, True),)
+
+    # NOTE every variable-length format is the only format of its opcode
+    fmt = var_fmt[0]
+    var_idx = 8 + fmt.var_off
+    var_spec = (var_idx >> 4, var_idx & 0xf, (1 << fmt.var_bits) - 1)
+    layouts = []
+    for var_arg in range(1 << fmt.var_bits):
+        valid = var_arg < len(fmt.var_formats)
+        if valid and fmt.var_formats[var_arg] is not None:
+            sub_formats = fmt.var_formats[var_arg]
+        else:
+            sub_formats = fmt.var_formats[-1]
+        fields, idx = _layout(sub_formats, 8)
+        layouts.append( (fields, idx >> 4, valid) )
+    return var_spec, tuple(layouts)
+
+# Per-opcode decoding table (see _tableEntry)
+ins_table = tuple( _tableEntry(ins_format[op]) for op in range(0x100) )
+
+# Maximum instruction length in 16-bit code units
+MAX_INS_UNITS = max( layout[1] for var_spec, layouts in ins_table
+        for layout in layouts )
+
+# Instruction length in 16-bit code units for each opcode
+# NOTE all variants of a variable-length format have the same length
+ins_units = tuple( layouts[-1][1] for var_spec, layouts in ins_table )
+
+# Return a 256-entry mask with ones at the opcodes named in names
+def opcodeMask(names):
+    names = set(names)
+    return array.array('B', ( ins_name[op] in names for op in range(0x100) ))
+
+# Decode the instruction at code unit pos of units (a sequence of 16-bit code
+# units padded with at least MAX_INS_UNITS zeros). Returns an Instruction that
+# matches the one produced by Instruction(intcode, pos*16).
+def decode(units, pos):
+    unit = units[pos]
+    op = unit & 0xff
+    var_spec, layouts = ins_table[op]
+
+    if var_spec is None:
+        fields, n_units, valid = layouts[0]
+    else:
+        var_unit, var_shift, var_mask = var_spec
+        var_arg = (units[pos + var_unit] >> var_shift) & var_mask
+        fields, n_units, valid = layouts[var_arg]
+        if not valid:
+            error(ins_format[op][0]._str,
+                    'invalid variable-length instruction arg: %d' % (var_arg))
+
+    values = []
+    for fmt, f_unit, f_units, shift, mask in fields:
+        value = units[pos + f_unit]
+        for k in range(1, f_units):
+            value |= units[pos + f_unit + k] << (k << 4)
+        f = fmt.__new__(fmt)
+        f.value = (value >> shift) & mask
+        values.append(f)
+
+    ins = Instruction.__new__(Instruction)
+    ins.op = op
+    ins.name = ins_name[op]
+    ins.formats = ins_format[op]
+    ins.idx = (pos + n_units) << 4
+    ins.fields = tuple(values)
+
+    if ins.name == 'UNUSED':
+        error('Instruction', '%s: read: %s' % (hex(pos << 4), format(ins)))
+
+    return ins
+
 if __name__ == '__main__':
 
     import sys, settings
@@ -7,11 +7,13 @@
 # https://source.android.com/devices/tech/dalvik/instruction-formats.html
 #
 
+import array
 import CodeFormat
 import math
 from message import *
 import settings
 import struct
+import sys
 
 # General class for parsing instructions
 class Instruction:
@@ -20,14 +22,124 @@ class Instruction:
     def __repr__(self):
         return 'Instruction' % self.format_args
 
+# Convert bytecode to an array of little-endian 16-bit code units
+# Returns (units, n_units) where units is padded with zeros so that decoding
+# never reads past its end and n_units excludes trailing zero code units
+def codeUnits(bytecode):
+    units = array.array('H')
+    units.frombytes(bytes(bytecode) + b'\0' * (len(bytecode) & 1))
+    if sys.byteorder == 'big':
+        units.byteswap()
+
+    # NOTE trailing zero code units are not decoded (as with the int parser)
+    n_units = len(units)
+    while n_units > 0 and units[n_units - 1] == 0:
+        n_units -= 1
+
+    units.extend(bytes(CodeFormat.MAX_INS_UNITS))
+    return units, n_units
+
+# Payload pseudo-instructions (nop opcodes with an identifier in the high
+# byte), which hold switch tables and array data
+PACKED_SWITCH_PAYLOAD = 0x0100
+SPARSE_SWITCH_PAYLOAD = 0x0200
+FILL_ARRAY_DATA_PAYLOAD = 0x0300
+PAYLOADS = (PACKED_SWITCH_PAYLOAD, SPARSE_SWITCH_PAYLOAD,
+        FILL_ARRAY_DATA_PAYLOAD)
+
+# Return the length in code units of the payload at code unit pos of the
+# n_units code units of units (None if its header is truncated)
+def payloadUnits(units, pos, n_units):
+    ident = units[pos]
+    if ident == FILL_ARRAY_DATA_PAYLOAD:
+        if pos + 4 > n_units:
+            return None
+        size = units[pos + 2] | (units[pos + 3] << 16)
+        return 4 + (units[pos + 1] * size + 1) // 2
+    if pos + 2 > n_units:
+        return None
+    if ident == PACKED_SWITCH_PAYLOAD:
+        return 4 + 2 * units[pos + 1]
+    return 2 + 4 * units[pos + 1]
+
+# Add the opcodes of bytecode to hist (a 256-entry opcode histogram) without
+# decoding instruction fields
+# NOTE payloads are skipped as in opcodeStream, so their data units are not
+# counted as opcodes
+def opcodeHistogram(bytecode, hist):
+    units, n_units = codeUnits(bytecode)
+    ins_units = CodeFormat.ins_units
+
+    pos = 0
+    while pos < n_units:
+        unit = units[pos]
+        if unit in PAYLOADS:
+            length = payloadUnits(units, pos, n_units)
+            if length is None:
+                break
+            pos += length
+            continue
+        op = unit & 0xff
+        hist[op] += 1
+        pos += ins_units[op]
+
+    return hist
+
+# Return the opcodes of the instructions of bytecode (one byte each) without
+# decoding instruction fields
+# NOTE payloads are data, not instructions, so they are skipped, and the
+# stream stops at a truncated payload
+def opcodeStream(bytecode):
+    units, n_units = codeUnits(bytecode)
+    ins_units = CodeFormat.ins_units
+
+    ops = bytearray()
+    pos = 0
+    while pos < n_units:
+        unit = units[pos]
+        if unit in PAYLOADS:
+            length = payloadUnits(units, pos, n_units)
+            if length is None:
+                break
+            pos += length
+            continue
+        op = unit & 0xff
+        ops.append(op)
+        pos += ins_units[op]
+
+    return ops
+
 # Object for parsing Dalvik bytecode
 class CodeParser:
 
-    def __init__(self, bytecode, dex_version):
+    def __init__(self, bytecode, dex_version, legacy=False):
         self.dex_version = dex_version
+        self.insns = []
+
+        if legacy:
+            self._parseInt(bytecode)
+        else:
+            self._parseUnits(bytecode)
+
+    # Decode instructions from 16-bit code units using CodeFormat.ins_table
+    def _parseUnits(self, bytecode):
+        units, n_units = codeUnits(bytecode)
+
+        pos = 0
+        while pos < n_units:
+            ins = CodeFormat.decode(units, pos)
+            if ins.name == 'UNUSED':
+                error('    ', 'Previous instruction: %s' %
+                        (format(self.insns[-1] if self.insns else None)))
+                error('    ', 'Code section bit size: %s' % (hex(n_units << 4)))
+            self.insns.append(ins)
+            pos = ins.idx >> 4
+
+    # Decode instructions by shifting bytecode converted to a large int
+    # NOTE this is quadratic in the bytecode size, use _parseUnits instead
+    def _parseInt(self, bytecode):
         # Convert bytecode to large int
         self.intcode = int.from_bytes(bytecode, byteorder='little')
-        self.insns = []
 
         i = 0
         while i < self.intcode.bit_length():
@@ -12,18 +12,160 @@
 # ?
 #
 
+import array
+import mmap
 from message import *
+import os
+import re
+import settings
 import struct
+import sys
 import math
+import time
 
 
 # Dex file magic constants
 DEX_MAGIC_PREFIX = tuple( [int(i, 16) for i in '0x64 0x65 0x78 0x0a'.split()] )
 
 
+# Error raised for DEX files that are invalid, truncated or point outside of
+# themselves
+class DexError(ValueError):
+    pass
+
+
+# File-like reader over a buffer (bytes, mmap) that returns zero-copy views
+class DexBuffer:
+
+    def __init__(self, buffer):
+
+        self.view = memoryview(buffer)
+        self.pos = 0
+
+    # Move to offset pos
+    def seek(self, pos):
+
+        self.pos = pos
+
+    # Return current offset
+    def tell(self):
+
+        return self.pos
+
+    # Return a view of the next n bytes
+    def read(self, n):
+
+        if self.pos + n > len(self.view):
+            raise DexError('cannot read %d bytes @ %s past the end of the DEX '
+                    'file (%d bytes)' % (n, hex(self.pos), len(self.view)))
+        view = self.view[self.pos:self.pos+n]
+        self.pos += n
+        return view
+
+    # Read a LEB128 value without creating views (see DexParser.leb128)
+    def readLeb128(self, signed=False):
+
+        view = self.view
+        value = 0
+        shift = 0
+
+        for i in range(5):  # NOTE LEB128 is at most 5 bytes in DEX format
+
+            try:
+                byte = view[self.pos]
+            except IndexError:
+                raise DexError('cannot read LEB128 @ %s past the end of the '
+                        'DEX file (%d bytes)' % (hex(self.pos), len(view)))
+            self.pos += 1
+            value |= (byte & 0x7f) << shift
+            shift += 7
+
+            if byte < 0x80:         # If flag is clear, this is the last byte
+                break
+
+        if signed and value >= (1 << (shift-1)):
+            value -= (1 << shift)
+
+        return value
+
+
+# Columnar table of fixed-size id items
+# Each field of the item is stored in its own array column. Item objects
+# (flyweights of DexTableItem subclasses) are only created on access.
+class DexTable:
+
+    def __init__(self, dex, item, data, size):
+
+        self.dex = dex          # DexParser, used to resolve references
+        self.item = item        # DexTableItem subclass
+        self.size = size
+        self.extra = {}         # Lazily loaded per-item data
+
+        # Split rows into columns with strided slices of the whole table
+        self.columns = []
+        offset = 0
+        for name, code in item.COLUMNS:
+            col = array.array(code)
+            col.frombytes(data[:item.STRUCT.size * size])
+            if sys.byteorder == 'big':
+                col.byteswap()
+            self.columns.append(col[offset // col.itemsize::
+                item.STRUCT.size // col.itemsize])
+            offset += col.itemsize
+
+    def __len__(self):
+
+        return self.size
+
+    def __getitem__(self, idx):
+
+        if idx < 0:
+            idx += self.size
+        if not 0 <= idx < self.size:
+            raise IndexError('%s index out of range' % (self.item.__name__))
+        return self.item(self, idx)
+
+    def __iter__(self):
+
+        return ( self.item(self, idx) for idx in range(self.size) )
+
+    def __repr__(self):
+
+        return format(list(self))
+
+    # Return the array holding column name
+    def column(self, name):
+
+        return self.columns[ [n for n, c in self.item.COLUMNS].index(name) ]
+
+
+# Base class for items of a DexTable
+# Subclasses list their fields as (name, array typecode) pairs in COLUMNS,
+# which become read-only attributes
+class DexTableItem:
+
+    __slots__ = ('table', 'idx')
+    COLUMNS = ()
+
+    def __init__(self, table, idx):
+
+        self.table = table
+        self.idx = idx
+
+    def __init_subclass__(cls):
+
+        cls.STRUCT = struct.Struct('<' + ''.join(c for n, c in cls.COLUMNS))
+        for i, (name, code) in enumerate(cls.COLUMNS):
+            setattr(cls, name, property(
+                lambda self, i=i: self.table.columns[i][self.idx]))
+
+
 # Object for storing DEX file header
 class DexHeader:
 
+    # Size of the header in bytes
+    SIZE = 0x70
+
     def __init__(self, dex_file):
 
         self.VALID = True
@@ -92,13 +234,15 @@ class DexMap:
             (1 << 13) + 6 : 'annotations_directory_item'
             }
 
-    def __init__(self, dex_file):
+    STRUCT = struct.Struct('<HxxII')
+
+    def __init__(self, values):
 
         (
             self.type,
             self.size,
             self.offset
-        ) = struct.unpack('HxxII', dex_file.read(12))
+        ) = values
 
     # Produce nice string formatting of object
     def __repr__(self):
@@ -108,11 +252,10 @@ class DexMap:
 
 
 # String identifier item object
-class DexStrId:
-
-    def __init__(self, dex_file):
+class DexStrId(DexTableItem):
 
-        self.offset, = struct.unpack('I', dex_file.read(4))
+    __slots__ = ()
+    COLUMNS = (('offset', 'I'),)
 
     # Nice string representation
     def __repr__(self):
@@ -124,16 +267,19 @@ class DexStrId:
 
         dex_file.seek(self.offset)  # Go to string_data_item
 
-        self.string_data_item = DexStrData(dex_file)
+        return DexStrData(dex_file)
 
 
 # Type id item object
-class DexTypeId:
+class DexTypeId(DexTableItem):
 
-    def __init__(self, dex_file, str_data):
+    __slots__ = ()
+    COLUMNS = (('descriptor_idx', 'I'),)
 
-        self.descriptor_idx, = struct.unpack('I', dex_file.read(4))
-        self.descriptor = str_data[self.descriptor_idx].data
+    @property
+    def descriptor(self):
+
+        return self.table.dex.string_data[self.descriptor_idx].data
 
     # String representation
     def __repr__(self):
@@ -148,7 +294,8 @@ class DexStrData:
 
         self.size = DexParser.parseLeb128(dex_file)
         # TODO convert from Modified UTF-8 encoding? (see documentation above)
-        self.data = dex_file.read(self.size)
+        # NOTE strings are copied to bytes since they are hashed and pickled
+        self.data = bytes(dex_file.read(self.size))
 
     # Nice string representation
     def __repr__(self):
@@ -157,20 +304,29 @@ class DexStrData:
 
 
 # Object for proto_id_item
-class DexProtoId:
+class DexProtoId(DexTableItem):
 
-    def __init__(self, dex_file, str_data, type_ids):
+    __slots__ = ()
+    COLUMNS = (
+        ('shorty_idx', 'I'),
+        ('return_type_idx', 'I'),
+        ('parameters_off', 'I'),
+    )
 
-        (
-            self.shorty_idx,
-            self.return_type_idx,
-            self.parameters_off
-        ) = struct.unpack('III', dex_file.read(12))
+    @property
+    def shorty_descriptor(self):
+
+        return self.table.dex.string_data[self.shorty_idx].data
 
-        self.shorty_descriptor = str_data[self.shorty_idx].data
-        self.return_type = type_ids[self.return_type_idx]
+    @property
+    def return_type(self):
 
-        self.parameters = None
+        return self.table.dex.type_ids[self.return_type_idx]
+
+    @property
+    def parameters(self):
+
+        return self.table.extra.get(self.idx)
 
     # Nice string representation
     def __repr__(self):
@@ -184,23 +340,33 @@ class DexProtoId:
             debug('loadProtoParams', 'reading proto. params \t@ %s' %
                     (hex(self.parameters_off)))
             dex_file.seek(self.parameters_off)
-            self.parameters = DexTypeList(dex_file, type_ids)
+            self.table.extra[self.idx] = DexTypeList(dex_file, type_ids)
 
 
 # Object for field_id_item
-class DexFieldId:
+class DexFieldId(DexTableItem):
 
-    def __init__(self, dex_file, type_ids, string_data):
+    __slots__ = ()
+    COLUMNS = (
+        ('class_idx', 'H'),
+        ('type_idx', 'H'),
+        ('name_idx', 'I'),
+    )
 
-        (
-            self.class_idx,
-            self.type_idx,
-            self.name_idx
-        ) = struct.unpack('HHI', dex_file.read(8))
+    @property
+    def clss(self):
 
-        self.clss = type_ids[self.class_idx]
-        self.type = type_ids[self.type_idx]
-        self.name = string_data[self.name_idx]
+        return self.table.dex.type_ids[self.class_idx]
+
+    @property
+    def type(self):
+
+        return self.table.dex.type_ids[self.type_idx]
+
+    @property
+    def name(self):
+
+        return self.table.dex.string_data[self.name_idx]
 
     # String representation
     def __repr__(self):
@@ -209,19 +375,29 @@ class DexFieldId:
 
 
 # Object for method_id_item
-class DexMethodId:
+class DexMethodId(DexTableItem):
 
-    def __init__(self, dex_file, type_ids, proto_ids, string_data):
+    __slots__ = ()
+    COLUMNS = (
+        ('class_idx', 'H'),
+        ('proto_idx', 'H'),
+        ('name_idx', 'I'),
+    )
 
-        (
-            self.class_idx,
-            self.proto_idx,
-            self.name_idx
-        ) = struct.unpack('HHI', dex_file.read(8))
+    @property
+    def type(self):
+
+        return self.table.dex.type_ids[self.class_idx]
+
+    @property
+    def prototype(self):
+
+        return self.table.dex.proto_ids[self.proto_idx]
 
-        self.type = type_ids[self.class_idx]
-        self.prototype = proto_ids[self.proto_idx]
-        self.name = string_data[self.name_idx].data
+    @property
+    def name(self):
+
+        return self.table.dex.string_data[self.name_idx].data
 
     # String representation
     def __repr__(self):
@@ -232,10 +408,10 @@ class DexMethodId:
 # Object for encoded_field
 class DexEncodedField:
 
-    def __init__(self, dex_file, field_ids):
+    def __init__(self, values, field_ids):
 
-        self.field_idx_diff = DexParser.parseLeb128(dex_file)
-        self.access_flags = DexAccessFlags(DexParser.parseLeb128(dex_file))
+        self.field_idx_diff, flags = values
+        self.access_flags = DexAccessFlags(flags)
 
         self.field = field_ids[self.field_idx_diff]
 
@@ -248,27 +424,38 @@ class DexEncodedField:
 # Object for encoded_method
 class DexEncodedMethod:
 
-    def __init__(self, dex_file, method_ids):
+    def __init__(self, values, method_ids):
 
-        self.method_idx_diff = DexParser.parseLeb128(dex_file)
-        self.access_flags = DexAccessFlags(DexParser.parseLeb128(dex_file))
-        self.code_off = DexParser.parseLeb128(dex_file)
+        self.method_idx_diff, flags, self.code_off = values
+        self.access_flags = DexAccessFlags(flags)
 
         self.method_id = method_ids[self.method_idx_diff]
-        self.code = None
+        self.dex = None     # DexParser to load code from on first access
 
     # String representation
     def __repr__(self):
 
         return 'method: %s @%s' % (self.method_id, hex(self.code_off))
 
+    # Load code_item on first access in lazy mode
+    def __getattr__(self, name):
+
+        dex = self.__dict__.get('dex')
+        if name != 'code' or dex is None:
+            raise AttributeError(name)
+
+        self.loadCode(DexBuffer(dex.view), dex.type_ids, lazy=True)
+        return self.code
+
     # Load code_item
-    def loadCode(self, dex_file, type_ids):
+    def loadCode(self, dex_file, type_ids, lazy=False):
+
+        self.code = None
 
         # If code offset is zero, the method is abstract or native
         if self.code_off != 0:
             dex_file.seek(self.code_off)
-            self.code = DexCode(dex_file, type_ids)
+            self.code = DexCode(dex_file, type_ids, lazy)
 
 
 # Object for access_flags
@@ -320,37 +507,67 @@ class DexTypeList:
 
 
 # Object for class_data_item
+# If dex is given, the encoded fields and methods are parsed on first access
+# and code_items are loaded from dex on first access
 class DexClassData:
 
-    def __init__(self, dex_file, type_ids, field_ids, method_ids):
+    # Attributes parsed on first access
+    LAZY = ('static_fields', 'instance_fields', 'direct_methods',
+            'virtual_methods')
+
+    def __init__(self, dex_file, type_ids, field_ids, method_ids, dex=None):
 
         self.static_fields_size = DexParser.parseLeb128(dex_file)
         self.instance_fields_size = DexParser.parseLeb128(dex_file)
         self.direct_methods_size = DexParser.parseLeb128(dex_file)
         self.virtual_methods_size = DexParser.parseLeb128(dex_file)
 
-        self.static_fields = []
-        self.instance_fields = []
-        self.direct_methods = []
-        self.virtual_methods = []
-
-        for i in range(self.static_fields_size):
-            self.static_fields.append(DexEncodedField(dex_file, field_ids))
-
-        for i in range(self.instance_fields_size):
-            self.instance_fields.append(DexEncodedField(dex_file, field_ids))
-
-        for i in range(self.direct_methods_size):
-            self.direct_methods.append(DexEncodedMethod(dex_file, method_ids))
-
-        for i in range(self.virtual_methods_size):
-            self.virtual_methods.append(DexEncodedMethod(dex_file, method_ids))
-
-        for m in self.direct_methods:
-            m.loadCode(dex_file, type_ids)
-
-        for m in self.virtual_methods:
-            m.loadCode(dex_file, type_ids)
+        if dex is not None:
+            self.deferred = (dex, dex_file.tell())
+        else:
+            self.deferred = None
+            self.loadMembers(dex_file, type_ids, field_ids, method_ids)
+
+    # Parse encoded fields and methods on first access in lazy mode
+    def __getattr__(self, name):
+
+        deferred = self.__dict__.get('deferred')
+        if name not in DexClassData.LAZY or deferred is None:
+            raise AttributeError(name)
+
+        dex, offset = deferred
+        self.deferred = None
+        dex_file = DexBuffer(dex.view)
+        dex_file.seek(offset)
+        self.loadMembers(dex_file, dex.type_ids, dex.field_ids, dex.method_ids,
+                dex)
+        return getattr(self, name)
+
+    # Parse encoded fields and methods
+    def loadMembers(self, dex_file, type_ids, field_ids, method_ids, dex=None):
+
+        n_fields = self.static_fields_size + self.instance_fields_size
+        n_methods = self.direct_methods_size + self.virtual_methods_size
+
+        # encoded_field values are mostly single bytes
+        values = DexParser.parseLeb128s(dex_file, 2*n_fields, runs=True)
+        fields = [ DexEncodedField(values[i:i+2], field_ids) for i in
+                range(0, 2*n_fields, 2) ]
+
+        values = DexParser.parseLeb128s(dex_file, 3*n_methods)
+        methods = [ DexEncodedMethod(values[i:i+3], method_ids) for i in
+                range(0, 3*n_methods, 3) ]
+
+        self.static_fields = fields[:self.static_fields_size]
+        self.instance_fields = fields[self.static_fields_size:]
+        self.direct_methods = methods[:self.direct_methods_size]
+        self.virtual_methods = methods[self.direct_methods_size:]
+
+        for m in self.direct_methods + self.virtual_methods:
+            if dex is not None:
+                m.dex = dex
+            else:
+                m.loadCode(dex_file, type_ids)
 
     # String representation
     def __repr__(self):
@@ -363,7 +580,9 @@ class DexClassData:
 # Object for class_def_item
 class DexClassDef:
 
-    def __init__(self, dex_file, type_ids, string_data):
+    STRUCT = struct.Struct('<IIIIIIII')
+
+    def __init__(self, values, dex):
 
         (
             self.class_idx,
@@ -374,24 +593,14 @@ class DexClassDef:
             self.annotations_off,
             self.class_data_off,
             self.static_values_off
-        ) = struct.unpack('IIIIIIII', dex_file.read(32))
+        ) = values
 
-        self.type_id = type_ids[self.class_idx]
+        self.dex = dex          # DexParser, used to resolve references
         self.access_flags = DexAccessFlags(self.flags)
 
         self.interfaces = None
         self.class_data = None
 
-        if self.superclass_idx != DexParser.NO_INDEX:
-            self.superclass = type_ids[self.superclass_idx]
-        else:
-            self.superclass = None
-
-        if self.source_file_idx != DexParser.NO_INDEX:
-            self.source_file = string_data[self.source_file_idx].data
-        else:
-            self.source_file = None
-
         if self.annotations_off != 0:
             # TODO parse annotations_directory_item
             self.annotations = None
@@ -404,6 +613,25 @@ class DexClassDef:
         else:
             self.static_values = None
 
+    @property
+    def type_id(self):
+
+        return self.dex.type_ids[self.class_idx]
+
+    @property
+    def superclass(self):
+
+        if self.superclass_idx == DexParser.NO_INDEX:
+            return None
+        return self.dex.type_ids[self.superclass_idx]
+
+    @property
+    def source_file(self):
+
+        if self.source_file_idx == DexParser.NO_INDEX:
+            return None
+        return self.dex.string_data[self.source_file_idx].data
+
     # String representation
     def __repr__(self):
 
@@ -416,24 +644,28 @@ class DexClassDef:
             dex_file.seek(self.interfaces_off)
             self.interfaces = DexTypeList(dex_file, type_ids)
 
-    # Load class_data_item
-    def loadClassData(self, dex_file, type_ids, field_ids, method_ids):
+    # Load class_data_item (code_items are loaded on first access if lazy)
+    def loadClassData(self, dex_file, type_ids, field_ids, method_ids,
+            lazy=False):
 
         if self.class_data_off != 0:
             dex_file.seek(self.class_data_off)
-            self.class_data = DexClassData(dex_file, type_ids, field_ids, method_ids)
+            self.class_data = DexClassData(dex_file, type_ids, field_ids,
+                    method_ids, self.dex if lazy else None)
 
 
 # Object for try_item
 class DexTry:
 
-    def __init__(self, dex_file):
+    STRUCT = struct.Struct('<IHH')
+
+    def __init__(self, values):
 
         (
             self.start_addr,
             self.insn_count,
             self.handler_off
-        ) = struct.unpack('IHH', dex_file.read(8))
+        ) = values
 
     # String representation
     def __repr__(self):
@@ -444,11 +676,10 @@ class DexTry:
 # Object for encoded_type_addr_pair
 class DexHandler:
 
-    def __init__(self, dex_file, type_ids):
+    def __init__(self, values, type_ids):
 
-        self.type_idx = DexParser.parseLeb128(dex_file)
+        self.type_idx, self.addr = values
         self.type = type_ids[self.type_idx]
-        self.addr = DexParser.parseLeb128(dex_file)
 
     # String representation
     def __repr__(self):
@@ -465,8 +696,10 @@ class DexCatchHandler:
         self.handlers = []
         self.catch_all_addr = None
 
-        for i in range(abs(self.size)):
-            self.handlers.append(DexHandler(dex_file, type_ids))
+        n = abs(self.size)
+        values = DexParser.parseLeb128s(dex_file, 2*n, runs=True)
+        self.handlers = [ DexHandler(values[i:i+2], type_ids) for i in
+                range(0, 2*n, 2) ]
 
         if self.size <= 0:
             self.catch_all_addr = DexParser.parseLeb128(dex_file)
@@ -480,9 +713,12 @@ class DexCatchHandler:
 
 
 # Object for code_item
+# If lazy, tries and handlers are loaded from dex_file on first access
 class DexCode:
 
-    def __init__(self, dex_file, type_ids):
+    STRUCT = struct.Struct('<HHHHII')
+
+    def __init__(self, dex_file, type_ids, lazy=False):
 
         (
             self.registers_size,
@@ -491,10 +727,33 @@ class DexCode:
             self.tries_size,
             self.debug_info_off,
             self.insns_size
-        ) = struct.unpack('HHHHII', dex_file.read(16))
+        ) = DexCode.STRUCT.unpack(dex_file.read(DexCode.STRUCT.size))
 
+        # NOTE insns is a zero-copy view when parsing from a DexBuffer
         self.insns = dex_file.read(self.insns_size*2)
 
+        if lazy:
+            self.deferred = (dex_file, dex_file.tell(), type_ids)
+        else:
+            self.deferred = None
+            self.loadTries(dex_file, type_ids)
+
+    # Load tries and handlers on first access in lazy mode
+    def __getattr__(self, name):
+
+        deferred = self.__dict__.get('deferred')
+        if name not in ('tries', 'handlers', 'handlers_size') or deferred is None:
+            raise AttributeError(name)
+
+        dex_file, offset, type_ids = deferred
+        self.deferred = None
+        dex_file.seek(offset)
+        self.loadTries(dex_file, type_ids)
+        return getattr(self, name)
+
+    # Load try_items and encoded_catch_handler_list following insns
+    def loadTries(self, dex_file, type_ids):
+
         # Move to 4-byte aligned offset
         dex_file.seek( (dex_file.tell() + 0x3) & ~0x3 )
 
@@ -503,8 +762,8 @@ class DexCode:
         self.handlers_size = 0
 
         if self.tries_size != 0:
-            for i in range(self.tries_size):
-                self.tries.append(DexTry(dex_file))
+            self.tries = [ DexTry(v) for v in DexTry.STRUCT.iter_unpack(
+                dex_file.read(DexTry.STRUCT.size * self.tries_size)) ]
 
             self.handlers_size = DexParser.parseLeb128(dex_file)
             for i in range(self.handlers_size):
@@ -516,39 +775,145 @@ class DexParser:
 
     NO_INDEX = int('0xffffffff', 16)
 
+    # Parsing phases in order
+    PHASES = (
+        'readHeader',
+        'readMap',
+        'readStrIds',
+        'readStrData',
+        'readTypeIds',
+        'readProtoIds',
+        'readProtoParams',
+        'readFieldIds',
+        'readMethodIds',
+        'readClassDefs',
+        'readInterfaces',
+        'readClassData',
+    )
+
+    # Tables and the phases that parse them
+    LAZY = {
+        'map' : ('readMap',),
+        'string_ids' : ('readStrIds',),
+        'string_data' : ('readStrData',),
+        'type_ids' : ('readTypeIds',),
+        'proto_ids' : ('readProtoIds', 'readProtoParams'),
+        'field_ids' : ('readFieldIds',),
+        'method_ids' : ('readMethodIds',),
+        'class_defs' : ('readClassDefs', 'readInterfaces', 'readClassData'),
+    }
+
+    # Run of single-byte LEB128 values
+    LEB128_RUN = re.compile(rb'[\x00-\x7f]+')
+
     header = None
-    map = []
-    string_ids = []
-    string_data = []
-    type_ids = []
-    proto_ids = []
-    field_ids = []
-    method_ids = []
-    class_defs = []
+    stats = {}
 
-    def __init__(self, dex_file_path):
+    # If buffer is given, the DEX file is parsed from memory and
+    # dex_file_path is only used for messages. Otherwise the file is
+    # memory-mapped if settings.DEX_MMAP is set and read in pieces if not.
+    #
+    # In lazy mode (settings.DEX_LAZY by default) only the header is parsed
+    # up front. Tables are parsed on first access (see LAZY), and code_items,
+    # their tries and handlers are loaded when first accessed.
+    def __init__(self, dex_file_path, buffer=None, lazy=None):
 
         self.FILE_PATH = dex_file_path
+        self.lazy = settings.DEX_LAZY if lazy is None else lazy
+        self.view = None        # DEX file contents, kept for lazy loading
 
         try:
-            with open(self.FILE_PATH, 'rb') as dex_file:
-
-                self.readHeader(dex_file)
-                self.readMap(dex_file)
-                self.readStrIds(dex_file)
-                self.readStrData(dex_file)
-                self.readTypeIds(dex_file)
-                self.readProtoIds(dex_file)
-                self.readProtoParams(dex_file)
-                self.readFieldIds(dex_file)
-                self.readMethodIds(dex_file)
-                self.readClassDefs(dex_file)
-                self.readInterfaces(dex_file)
-                self.readClassData(dex_file)
+            if buffer is None and (settings.DEX_MMAP or self.lazy):
+                buffer = self.mapFile()
+
+            if buffer is not None:
+                self.view = memoryview(buffer)
+                self.parse(DexBuffer(self.view), len(self.view))
+            else:
+                with open(self.FILE_PATH, 'rb') as dex_file:
+                    self.parse(dex_file, os.fstat(dex_file.fileno()).st_size)
 
         except FileNotFoundError:
             error('DexParser', '%s does not exist' % (self.FILE_PATH))
 
+    # Memory-map the DEX file (or read it whole if settings.DEX_MMAP is unset)
+    # NOTE an empty file cannot be mapped, so it is returned as empty bytes
+    # NOTE the mapping stays alive as long as views of it (e.g. DexCode.insns)
+    # do
+    def mapFile(self):
+
+        with open(self.FILE_PATH, 'rb') as dex_file:
+            if os.fstat(dex_file.fileno()).st_size == 0:
+                return b''
+            if settings.DEX_MMAP:
+                return mmap.mmap(dex_file.fileno(), 0, access=mmap.ACCESS_READ)
+            return dex_file.read()
+
+    # Parse tables on first access
+    def __getattr__(self, name):
+
+        phases = DexParser.LAZY.get(name)
+        if phases is None:
+            raise AttributeError(name)
+
+        # Nothing to parse (missing DEX file)
+        if self.__dict__.get('view') is None:
+            return []
+
+        for phase in phases:
+            self.runPhase(phase, DexBuffer(self.view))
+
+        return self.__dict__[name]
+
+    # Parse all DEX file sections of a DEX file of length bytes
+    # Per-phase wall time (seconds) and net allocated memory blocks are
+    # stored in self.stats and reported if settings.PROFILE is set
+    # Raises DexError if the header is invalid or the sections it points to
+    # are not in the file, before any of them is parsed (so lazy mode fails
+    # like eager mode)
+    def parse(self, dex_file, length):
+
+        self.stats = {}
+
+        if length < DexHeader.SIZE:
+            raise DexError('%s is truncated: %d bytes, shorter than a DEX '
+                    'header' % (self.FILE_PATH, length))
+
+        self.runPhase('readHeader', dex_file)
+        self.checkBounds(length)
+
+        if self.lazy:
+            return
+
+        for phase in DexParser.PHASES[1:]:
+            self.runPhase(phase, dex_file)
+
+        if settings.PROFILE:
+            self.reportStats()
+
+    # Run a parsing phase and record its statistics
+    def runPhase(self, phase, dex_file):
+
+        blocks = sys.getallocatedblocks()
+        start = time.perf_counter()
+
+        getattr(self, phase)(dex_file)
+
+        self.stats[phase] = {
+            'time' : time.perf_counter() - start,
+            'blocks' : sys.getallocatedblocks() - blocks,
+        }
+
+    # Print per-phase parsing statistics
+    def reportStats(self):
+
+        total = sum(s['time'] for s in self.stats.values())
+        for phase, s in self.stats.items():
+            verb('DexParser', '%-16s %8.2fms %5.1f%% %+10d blocks' % (phase,
+                1000*s['time'], 100*s['time']/total if total else 0,
+                s['blocks']))
+        verb('DexParser', '%-16s %8.2fms' % ('total', 1000*total))
+
     # Parse DEX file header
     def readHeader(self, dex_file):
         self.header = DexHeader(dex_file)
@@ -558,19 +923,44 @@ class DexParser:
             verb('readHeader', 'found DEX v.%d header for %s' %
                     (self.header.VERSION, self.FILE_PATH))
         else:
-            error('readHeader', 'invalid DEX header magic for %s' %
-                    (self.FILE_PATH))
-            return
+            raise DexError('invalid DEX header magic for %s' % (self.FILE_PATH))
 
         # Check file endianness
         if self.header.endian_tag == int('0x78563412', 16):
-            warn('readHeader', 'found reversed endian tag in %s' %
-                    (dex_file_path))
-            error('readHeader', 'reversed endian parsing not implemented',
-                    fatal=True)
+            raise DexError('reversed endian parsing not implemented for %s' %
+                    (self.FILE_PATH))
         elif self.header.endian_tag != int('0x12345678', 16):
             error('readHeader', 'found invalid endian tag for %s' %
-                    (dex_file_path))
+                    (self.FILE_PATH))
+
+    # Raise DexError unless the sections the header points to are in the
+    # length bytes of the DEX file
+    def checkBounds(self, length):
+
+        header = self.header
+        if header.file_size > length:
+            raise DexError('%s is truncated: %d of %d bytes' % (
+                    self.FILE_PATH, length, header.file_size))
+
+        for name, offset, size in (
+                ('map', header.map_off, 4),
+                ('string ids', header.string_ids_off,
+                    header.string_ids_size * DexStrId.STRUCT.size),
+                ('type ids', header.type_ids_off,
+                    header.type_ids_size * DexTypeId.STRUCT.size),
+                ('proto ids', header.proto_ids_off,
+                    header.proto_ids_size * DexProtoId.STRUCT.size),
+                ('field ids', header.field_ids_off,
+                    header.field_ids_size * DexFieldId.STRUCT.size),
+                ('method ids', header.method_ids_off,
+                    header.method_ids_size * DexMethodId.STRUCT.size),
+                ('class defs', header.class_defs_off,
+                    header.class_defs_size * DexClassDef.STRUCT.size),
+                ('data', header.data_off, header.data_size)):
+            if offset + size > header.file_size:
+                raise DexError('%s of %s (%d bytes @ %s) are past the end of '
+                        'the file (%d bytes)' % (name, self.FILE_PATH, size,
+                        hex(offset), header.file_size))
 
     # Parse DEX file map
     def readMap(self, dex_file):
@@ -581,7 +971,8 @@ class DexParser:
         size, = struct.unpack('I', dex_file.read(4))    # Parse # of elements in the DEX map
 
         # return array of DexMap objects
-        self.map = [ DexMap(dex_file) for i in range(size) ]
+        self.map = [ DexMap(v) for v in
+                DexParser.readItems(dex_file, DexMap, dex_file.tell(), size) ]
 
     # Parse string identifier list
     def readStrIds(self, dex_file):
@@ -589,10 +980,8 @@ class DexParser:
         verb('readStrIds', 'reading string ids \t\t@ %s' %
                 (hex(self.header.string_ids_off)) )
 
-        dex_file.seek(self.header.string_ids_off)   # Go to string identifiers list
-
-        self.string_ids = [ DexStrId(dex_file) for i in
-                range(self.header.string_ids_size) ]
+        self.string_ids = self.readTable(dex_file, DexStrId,
+                self.header.string_ids_off, self.header.string_ids_size)
 
     # Parse string data
     def readStrData(self, dex_file):
@@ -601,8 +990,8 @@ class DexParser:
                 (hex(self.string_ids[0].offset)))
 
         self.string_data = []
-        for sid in self.string_ids:
-            dex_file.seek(sid.offset)
+        for offset in self.string_ids.column('offset'):
+            dex_file.seek(offset)
             self.string_data.append(DexStrData(dex_file))
 
     # Parse type ids
@@ -611,10 +1000,8 @@ class DexParser:
         verb('readTypeIds', 'reading type ids \t\t@ %s' %
                 (hex(self.header.type_ids_off)))
 
-        dex_file.seek(self.header.type_ids_off)
-
-        self.type_ids = [ DexTypeId(dex_file, self.string_data) for i in
-                range(self.header.type_ids_size) ]
+        self.type_ids = self.readTable(dex_file, DexTypeId,
+                self.header.type_ids_off, self.header.type_ids_size)
 
     # Parse prototype ids
     def readProtoIds(self, dex_file):
@@ -622,10 +1009,8 @@ class DexParser:
         verb('readProtoIds', 'reading prototype ids \t@ %s' %
                 (hex(self.header.proto_ids_off)))
 
-        dex_file.seek(self.header.proto_ids_off)
-
-        self.proto_ids = [ DexProtoId(dex_file, self.string_data, self.type_ids)
-                for i in range(self.header.proto_ids_size) ]
+        self.proto_ids = self.readTable(dex_file, DexProtoId,
+                self.header.proto_ids_off, self.header.proto_ids_size)
 
     # Parse prototype parameters
     def readProtoParams(self, dex_file):
@@ -639,10 +1024,8 @@ class DexParser:
         verb('readFieldIds', 'reading field ids \t@ %s' %
                 (hex(self.header.field_ids_off)))
 
-        dex_file.seek(self.header.field_ids_off)
-
-        self.field_ids = [ DexFieldId(dex_file, self.type_ids, self.string_data)
-                for i in range(self.header.field_ids_size) ]
+        self.field_ids = self.readTable(dex_file, DexFieldId,
+                self.header.field_ids_off, self.header.field_ids_size)
 
     # Parse method ids
     def readMethodIds(self, dex_file):
@@ -650,10 +1033,8 @@ class DexParser:
         verb('readMethodIds', 'reading method ids \t@ %s' %
                 (hex(self.header.method_ids_off)))
 
-        dex_file.seek(self.header.method_ids_off)
-
-        self.method_ids = [ DexMethodId(dex_file, self.type_ids, self.proto_ids,
-            self.string_data) for i in range(self.header.method_ids_size) ]
+        self.method_ids = self.readTable(dex_file, DexMethodId,
+                self.header.method_ids_off, self.header.method_ids_size)
 
     # Parse class definitions
     def readClassDefs(self, dex_file):
@@ -661,28 +1042,121 @@ class DexParser:
         verb('readClassDefs', 'reading class defs \t@ %s' %
                 (hex(self.header.class_defs_off)))
 
-        dex_file.seek(self.header.class_defs_off)
-
-        self.class_defs = [ DexClassDef(dex_file, self.type_ids,
-            self.string_data) for i in range(self.header.class_defs_size) ]
+        self.class_defs = [ DexClassDef(v, self)
+                for v in DexParser.readItems(dex_file, DexClassDef,
+                    self.header.class_defs_off, self.header.class_defs_size) ]
 
     # Parse interfaces
     def readInterfaces(self, dex_file):
 
         for c in self.class_defs:
-            c.loadClassData(dex_file, self.type_ids, self.field_ids, self.method_ids)
+            c.loadInterfaces(dex_file, self.type_ids)
 
     # Parse class data
     def readClassData(self, dex_file):
 
         for c in self.class_defs:
-            c.loadClassData(dex_file, self.type_ids, self.field_ids, self.method_ids)
+            c.loadClassData(dex_file, self.type_ids, self.field_ids,
+                    self.method_ids, self.lazy)
+
+    # Read a table of size fixed-size items at offset
+    # Returns an iterator of value tuples unpacked with item.STRUCT
+    @staticmethod
+    def readItems(dex_file, item, offset, size):
+
+        dex_file.seek(offset)
+        return item.STRUCT.iter_unpack(dex_file.read(item.STRUCT.size * size))
+
+    # Read a table of size id items at offset into a columnar DexTable
+    def readTable(self, dex_file, item, offset, size):
 
+        dex_file.seek(offset)
+        return DexTable(self, item, dex_file.read(item.STRUCT.size * size), size)
+
+    # Parse n LEB128 values from the current position of a file or DexBuffer
+    # If runs is set, unsigned values are decoded with leb128Runs
+    @staticmethod
+    def parseLeb128s(dex_file, n, signed=False, runs=False):
+
+        if type(dex_file) is DexBuffer:
+            buffer, start = dex_file.view, dex_file.pos
+        else:
+            # NOTE LEB128 is at most 5 bytes in DEX format
+            buffer, start = dex_file.read(5*n), 0
+
+        if runs and not signed:
+            values, end = DexParser.leb128Runs(buffer, start, n)
+        else:
+            values, end = DexParser.leb128s(buffer, start, n, signed)
+
+        if type(dex_file) is DexBuffer:
+            dex_file.pos = end
+        else:
+            dex_file.seek(dex_file.tell() - len(buffer) + end)
+
+        return values
+
+    # Decode n LEB128 values from buffer starting at offset
+    # Returns (values, offset after the last value)
+    @staticmethod
+    def leb128s(buffer, offset, n, signed=False):
+
+        values = []
+
+        for i in range(n):
+
+            byte = buffer[offset]
+            offset += 1
+            value = byte & 0x7f
+            shift = 7
+
+            # NOTE LEB128 is at most 5 bytes in DEX format
+            while byte >= 0x80 and shift < 35:
+                byte = buffer[offset]
+                offset += 1
+                value |= (byte & 0x7f) << shift
+                shift += 7
+
+            if signed and value >= (1 << (shift-1)):
+                value -= (1 << shift)
+
+            values.append(value)
+
+        return values, offset
+
+    # Decode n unsigned LEB128 values from buffer starting at offset
+    # Runs of single-byte values are found with a regular expression and
+    # copied in one step, so this is much faster than leb128s for lists of
+    # small values (e.g. encoded_field) but slower for mostly multi-byte ones
+    @staticmethod
+    def leb128Runs(buffer, offset, n):
+
+        values = []
+
+        while len(values) < n:
+
+            # Copy a run of single-byte values
+            run = DexParser.LEB128_RUN.match(buffer, offset)
+            if run is not None:
+                end = min(run.end(), offset + n - len(values))
+                values.extend(buffer[offset:end])
+                offset = end
+                if len(values) == n:
+                    break
+
+            # Decode a multi-byte value
+            value, offset = DexParser.leb128s(buffer, offset, 1)
+            values += value
+
+        return values, offset
 
     # Method for parsing LEB128 integer values from files
     @staticmethod
     def parseLeb128(dex_file, signed=False):
 
+        if type(dex_file) is DexBuffer:
+            return dex_file.readLeb128(signed)
+
         byte_data = []
 
         for i in range(5):  # NOTE LEB128 is at most 5 bytes in DEX format
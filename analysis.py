@@ -3,18 +3,33 @@
 # analysis.py: feature extraction from apk files
 #
 
-from CodeParser import CodeParser
+import CodeFormat
+from ArscParser import ArscParser
+from cache import CACHE_VERSION, FeatureCache, codeHash, fileHash, methodCache
+from CodeParser import CodeParser, opcodeHistogram, opcodeStream
 from bs4 import BeautifulSoup
+from collections import Counter
 import data
 from DexParser import DexParser
-import math
+from extractor import Extractor, apktoolCommand, apktoolOptions
+from journal import Journal
 from message import *
-from multiprocessing import Pool
+from multiprocessing import Pool, current_process
 from ngrams import *
 import os
+import pickle
+import re
+from scheduler import Scheduler
+from scratch import Scratch
 import settings
 import shutil
+from sketch import CountMinSketch, NgramSketch, getSketchDocFreq
 import subprocess
+import tempfile
+from tfidf import NgramMatrix, TfidfModel, getIdf, getTfidf, getTopNgrams
+import time
+from transport import attach, share, track
+import zipfile
 
 IMMEDIATE_LITERAL_TYPES = ("Const4", "Const16", "Const", "ConstHigh16",
         "ConstWide16", "ConstWide32", "ConstWide", "ConstWideHigh16")
@@ -43,69 +58,96 @@ BINARY_OPERATOR_TYPES = ( "AddInt", "SubInt", "MulInt", "DivInt", "RemInt",
     "DivIntLit8", "RemIntLit8", "AndIntLit8", "OrIntLit8", "XorIntLit8",
     "ShlIntLit8", "ShrIntLit8", "UshrIntLit8")
 
-# Class for analyzing an APK file (does not perform TF-IDF analysis)
-class ApkAnalyzer:
-
-    def __init__(self, apk_file):
-
-        self.finished = False
-
-        # Check if apk_file exists
-        if not os.path.exists(apk_file):
-            error('ApkAnalyzer', 'file not found: %s' % (apk_file))
-            return
-
-        self.file = apk_file            # APK file path
-        self.dir = apk_file + '.dec'    # extracted APK directory
-
-        self.ngrams = {}                # Contains all the ngrams found in the apk
-        self.vector = data.FeatureVector()  # Feature vector
+# DEX files of an APK, numbered from 2 after classes.dex
+DEX_FILE = re.compile(r'classes(\d*)\.dex')
+
+# Opcode masks for the instruction types above
+IMMEDIATE_LITERAL_MASK = CodeFormat.opcodeMask(IMMEDIATE_LITERAL_TYPES)
+UNARY_OPERATOR_MASK = CodeFormat.opcodeMask(UNARY_OPERATOR_TYPES)
+BINARY_OPERATOR_MASK = CodeFormat.opcodeMask(BINARY_OPERATOR_TYPES)
+
+# Return an empty NgramSketch of the configured size
+def ngramSketch():
+    return NgramSketch(settings.NGRAM_SIZE, settings.SKETCH_WIDTH,
+            settings.SKETCH_DEPTH, settings.HEAVY_HITTERS)
+
+# Return the ngram lengths in settings.NGRAM_SWEEP other than
+# settings.NGRAM_SIZE, which are counted in the same pass as it and stored in
+# the feature cache (so they are only counted if it is enabled)
+def sweepSizes():
+    if (settings.FEATURE_CACHE is None or settings.NGRAM_SKETCH or
+            not settings.STRING_NGRAMS):
+        return ()
+    return tuple(sorted(set(settings.NGRAM_SWEEP) - {settings.NGRAM_SIZE}))
+
+# Return the key of the journal, made of the settings that shape the results
+# of an ApkAnalyzer
+def journalKey():
+    return (CACHE_VERSION, settings.EXTRACT_BACKEND, settings.COUNT_OPCODES,
+            settings.NGRAM_SIZE, settings.STRING_NGRAMS, sweepSizes(),
+            settings.STREAM,
+            settings.NGRAM_SKETCH and (settings.SKETCH_WIDTH,
+            settings.SKETCH_DEPTH, settings.HEAVY_HITTERS),
+            settings.OPCODE_NGRAMS and tuple(settings.OPCODE_NGRAM_SIZES))
+
+# Return the key of the settings that shape ngram ids, for the TF-IDF model
+def modelKey():
+    return (CACHE_VERSION, settings.EXTRACT_BACKEND, settings.NGRAM_SIZE,
+            settings.STRING_NGRAMS)
+
+# Return the parts of an APK the enabled features read: 'dex' for the DEX
+# files (code features, bytecode and opcode ngrams) and 'strings' for the
+# string resources (settings.STRING_NGRAMS), or also 'all' to read everything
+# if settings.EXTRACT_PLAN is not set
+def extractionPlan():
+    if not settings.EXTRACT_PLAN:
+        return frozenset(('dex', 'strings', 'all'))
+    plan = {'dex'}
+    if settings.STRING_NGRAMS:
+        plan.add('strings')
+    return frozenset(plan)
+
+# Return the DEX file names (classes.dex, classes2.dex, ...) in names in
+# loading order
+def dexFiles(names):
+    dex_files = [ n for n in names if DEX_FILE.fullmatch(n) ]
+    return sorted(dex_files, key=lambda n: int(DEX_FILE.fullmatch(n)[1] or 1))
+
+# Class for analyzing one DEX file of an APK (class and bytecode features)
+class DexAnalyzer:
+
+    def __init__(self, apk_file, name, path=None):
+
+        self.file = os.path.join(apk_file, name)  # DEX file path (for messages)
+        self.apk_file = apk_file        # APK file path
+        self.name = name                # DEX file name in the APK
+        self.path = path                # Extracted DEX file path (if extracted)
+
+        self.vector = data.FeatureVector()  # Class features and opcode counts
         self.dex = None                 # DexParser object
         self.bytecode = []              # Array of bytecode sections
         self.code = []                  # Array of CodeParser objects
-
-
-    # Extract/decrypt APK file using `apktool`
-    def extract(self):
-
-        # This is the command that extracts the APK file
-        # Flags:
-        #   d   This instructs apktool to decode an APK file
-        #  -f   This deletes the destination directory if it exists
-        #  -s   This prevents apktool from generating source code from classes.dex
-        #  -o   This precedes the desired name of the output directory
-        cmd = 'apktool d -f -s -o %s %s' % (self.dir, self.file)
-
-        verb('extract', 'extracting %s to %s ...' % (self.file, self.dir))
-
-        # Fork command
-        with subprocess.Popen(cmd.split(), stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE) as proc:
-
-            # Wait for command completion
-            proc.wait()
-
-            # If the process exited with errors, print its output
-            if proc.returncode != 0:
-                error('extract', 'encountered errors for %s' % (self.file))
-                error('extract', '\n%s' % (proc.stderr.read().decode()) )
-            else:
-                verb('extract', 'extraction completed successfuly')
-    
-    # Remove extracted directory
-    def remove(self):
-        verb('remove', 'delete extracted directory %s' % (self.dir))
-        shutil.rmtree(self.dir, ignore_errors=True)
+        self.code_ngrams = {}           # Bytecode ngrams
+        self.code_sketch = None         # Bytecode ngram sketch (settings.NGRAM_SKETCH)
+        self.code_sweep = {}            # { n : bytecode ngrams } of sweepSizes()
+        self.op_ngrams = {}             # Opcode ngrams (settings.OPCODE_NGRAMS)
+        self.method_hits = 0            # Method bodies found in the method cache
+        self.method_misses = 0          # Method bodies missing from the method cache
 
     # Load and parse DEX file
     def loadDex(self):
 
-        self.dex = DexParser(os.path.join(self.dir, 'classes.dex'))
+        if self.path is not None:
+            self.dex = DexParser(self.path)
+        else:
+            with zipfile.ZipFile(self.apk_file) as apk:
+                self.dex = DexParser(self.file, apk.read(self.name))
 
     # Get number of direct/virtual methods, static/instance fields, abstract methods
     def getClassFeatures(self):
 
-        verb('getClassFeatures', 'Extracting class features...')
+        verb('getClassFeatures', 'Extracting class features from %s...' %
+                (self.file))
         for cls in self.dex.class_defs:
             if cls.class_data is not None:
                 self.vector.n_direct_methods += cls.class_data.direct_methods_size
@@ -115,7 +157,7 @@ class ApkAnalyzer:
 
                 # Direct methods
                 for m in cls.class_data.direct_methods:
-                    if m.code is None:
+                    if m.code_off == 0:
                         # Get number of abstract direct methods
                         self.vector.n_abstract_direct_methods += 1
                     elif m.code.tries_size != 0:
@@ -123,13 +165,10 @@ class ApkAnalyzer:
                         self.vector.n_error_handling_methods += 1
                         # Store bytecode
                         self.bytecode.append(m.code.insns)
-                        # Parse bytecode
-                        self.code.append(CodeParser(m.code.insns,
-                            self.dex.header.VERSION))
 
                 # Virtual methods
                 for m in cls.class_data.virtual_methods:
-                    if m.code is None:
+                    if m.code_off == 0:
                         # Get number of abstract virtual methods
                         self.vector.n_abstract_virtual_methods += 1
                     elif m.code.tries_size != 0:
@@ -137,9 +176,6 @@ class ApkAnalyzer:
                         self.vector.n_error_handling_methods += 1
                         # Store bytecode
                         self.bytecode.append(m.code.insns)
-                        # Parse bytecode
-                        self.code.append(CodeParser(m.code.insns,
-                            self.dex.header.VERSION))
 
                 # Static fields
                 for f in cls.class_data.static_fields:
@@ -153,52 +189,89 @@ class ApkAnalyzer:
                         # Get number of final instance fields
                         self.vector.n_total_final_instance_fields += 1
 
-    # Get features from bytecode
-    def getCodeFeatures(self):
-
-        for c in self.code:
-            for ins in c.insns:
-                if ins.name in IMMEDIATE_LITERAL_TYPES:
-                    self.vector.n_total_immediate_constants += 1
-                if ins.name in UNARY_OPERATOR_TYPES:
-                    self.vector.n_total_unary_operators += 1
-                if ins.name in BINARY_OPERATOR_TYPES:
-                    self.vector.n_total_binary_operators += 1
-
-    def getNgramFeatures(self, path="res/values/strings.xml"):
+    # Get opcode histogram and ngrams of the bytecode, counting each distinct
+    # method body once and only if it is not in the method cache
+    def getMethodFeatures(self):
 
-        path = os.path.join(self.dir, path)
-
-        if not os.path.exists(path):
-            error('get_n_grams', 'Path %s does not exist' % (path))
-            return
+        cache = methodCache(settings.METHOD_CACHE, settings.METHOD_CACHE_SIZE)
 
-        with open(path) as xml_file:
-            parser = BeautifulSoup(xml_file, features="lxml-xml")
-
-        strings = parser.findAll("string")
-
-        for i in range(len(strings)):
-            strings[i] = bytes(strings[i].text, encoding='utf-8')
+        # Number of occurrences of each distinct method body
+        occurrences = {}
+        bodies = {}
+        for b in self.bytecode:
+            key = codeHash(b)
+            if key in occurrences:
+                occurrences[key] += 1
+            else:
+                occurrences[key] = 1
+                bodies[key] = b
+
+        features = cache.get(occurrences, settings.NGRAM_SIZE)
+
+        missing = {}
+        for key in occurrences:
+            if key not in features:
+                missing[key] = (opcodeHistogram(bodies[key], Counter()),
+                        get_n_grams((bodies[key],), settings.NGRAM_SIZE))
+        cache.put(missing, settings.NGRAM_SIZE)
+        features.update(missing)
+
+        self.method_hits = len(features) - len(missing)
+        self.method_misses = len(missing)
+
+        # NOTE ngrams are inserted in the order they occur in self.bytecode
+        for key, n in occurrences.items():
+            hist, ngrams = features[key]
+            for op, count in hist.items():
+                self.vector.opcodes[op] += n * count
+            if self.code_sketch is not None:
+                self.code_sketch.update({ ngram : n * count for ngram, count in
+                    ngrams.items() })
+            else:
+                for ngram, count in ngrams.items():
+                    if ngram in self.code_ngrams:
+                        self.code_ngrams[ngram] += n * count
+                    else:
+                        self.code_ngrams[ngram] = n * count
+
+        # NOTE the method cache only holds ngrams of settings.NGRAM_SIZE, so
+        # the other lengths are counted over the bytecode
+        if sweepSizes():
+            self.code_sweep = get_multi_n_grams(self.bytecode, sweepSizes())
+
+        verb('getMethodFeatures', '%s: %d methods, %d in method cache, %d new' %
+                (self.file, len(self.bytecode), self.method_hits,
+                    self.method_misses))
+
+    # Get opcode histogram of the bytecode
+    def getCodeFeatures(self):
 
-        # Begin by parsing ngrams from `path`
-        self.ngrams = get_n_grams(strings)
+        if settings.COUNT_OPCODES:
+            # Only walk opcodes, instructions are never decoded
+            for b in self.bytecode:
+                opcodeHistogram(b, self.vector.opcodes)
+        else:
+            for b in self.bytecode:
+                c = CodeParser(b, self.dex.header.VERSION)
+                self.code.append(c)
+                for ins in c.insns:
+                    self.vector.opcodes[ins.op] += 1
 
-        # Next parse ngrams from code sections
-        data.updateOccurrences(self.ngrams, get_n_grams(self.bytecode))
+    # Get ngrams of the bytecode
+    def getNgramFeatures(self):
 
-        verb('getNgramFeatures', 'Successfully extracted %d ngrams' %
-                (len(self.ngrams)))
+        if self.code_sketch is not None:
+            self.code_sketch.addStrings(self.bytecode)
+        else:
+            self.code_sweep = get_multi_n_grams(self.bytecode,
+                    (settings.NGRAM_SIZE, *sweepSizes()))
+            self.code_ngrams = self.code_sweep.pop(settings.NGRAM_SIZE)
 
-    # Add top_n ngrams to the feature vector sorted by TF-IDFs in self.ngrams
-    def getTfidfFeatures(self, top_n=5):
-        # Sort ngrams by TF-IDF
-        ngrams_sorted = sorted(self.ngrams, key=self.ngrams.get, reverse=True)
-        verb('getTfidfFeatures', ngrams_sorted[:top_n])
+    # Get ngrams of the opcodes of the bytecode
+    def getOpcodeNgramFeatures(self):
 
-        # Store top 5 ngrams each as a number
-        self.vector.top_ngrams = (int.from_bytes(ngrams_sorted[i], 'little') for
-                i in range(top_n))
+        self.op_ngrams = get_opcode_n_grams((opcodeStream(b) for b in
+            self.bytecode), settings.OPCODE_NGRAM_SIZES)
 
     # Debug
     def _debug(self):
@@ -216,18 +289,299 @@ class ApkAnalyzer:
         verb('debug', self.dex.map)
 
     # Remove references to bulky objects to allow garbage collection
+    # NOTE a finished DexAnalyzer only holds its vector and code ngrams, so it
+    # is cheap to return from a pool worker
     def clean(self):
         del self.dex
         del self.bytecode
         del self.code
+        if self.code_sketch is not None:
+            self.code_sketch.flush()
+
+    # Run analysis of the DEX file
+    def run(self):
+
+        if settings.NGRAM_SKETCH:
+            self.code_sketch = ngramSketch()
+
+        self.loadDex()
+        self.getClassFeatures()
+        if settings.METHOD_CACHE is not None:
+            self.getMethodFeatures()
+        else:
+            self.getCodeFeatures()
+            self.getNgramFeatures()
+        if settings.OPCODE_NGRAMS:
+            self.getOpcodeNgramFeatures()
+        self.clean()
+        return self
+
+
+# Class for analyzing an APK file (does not perform TF-IDF analysis)
+class ApkAnalyzer:
+
+    # Attributes holding the ngram arrays sent back from pool workers in
+    # shared memory
+    SHARED = ('ngram_ids', 'ngram_counts', 'sweep_ngrams', 'op_ngrams')
+
+    def __init__(self, apk_file, directory=None):
+
+        self.finished = False
+
+        # Check if apk_file exists
+        if not os.path.exists(apk_file):
+            error('ApkAnalyzer', 'file not found: %s' % (apk_file))
+            return
+
+        self.file = apk_file            # APK file path
+        self.sha256 = None              # APK content hash (for caching)
+        self.dir = directory or apk_file + '.dec'   # extracted APK directory
+        self.extracted = False          # Whether self.dir was extracted by an Extractor
+
+        self.ngrams = {}                # Contains all the ngrams found in the apk
+        self.vector = data.FeatureVector()  # Feature vector
+        self.dex_files = []             # DEX file names (classes.dex, classes2.dex, ...)
+        self.strings = None             # String resources read from the APK
+        self.code_ngrams = {}           # Bytecode ngrams of all DEX files
+        self.code_sweep = {}            # { n : bytecode ngrams } of sweepSizes()
+        self.sketch = None              # Ngram sketch (settings.NGRAM_SKETCH)
+        self.method_hits = 0            # Method bodies found in the method cache
+        self.method_misses = 0          # Method bodies missing from the method cache
+
+        self.ngram_size = settings.NGRAM_SIZE  # Length of ngrams
+        self.ngram_ids = None           # Ngram ids (set by compact)
+        self.ngram_counts = None        # Ngram occurrences (set by compact)
+        self.ngram_total = None         # Occurrences of all ngrams (if self.ngrams are heavy hitters)
+        self.sweep_ngrams = {}          # { n : (ngram ids, occurrences) } of sweepSizes() (for the feature cache)
+        self.op_ngrams = None           # Opcode ngram (ids, occurrences) (settings.OPCODE_NGRAMS)
+        self.spill_offset = None        # Offset of the ngrams in the ApkSet spill file
+        self.op_spill_offset = None     # Offset of the opcode ngrams in the ApkSet spill file
+        self.shm = None                 # Shared memory segment of the arrays in SHARED (transport)
+
+
+    # Extract the parts of the APK file in extractionPlan() with the
+    # configured backend
+    def extract(self):
+
+        plan = extractionPlan()
+        if settings.EXTRACT_BACKEND == 'apktool':
+            if not self.extracted:
+                self.extractApktool(plan)
+            self.dex_files = dexFiles(os.listdir(self.dir)
+                    if os.path.isdir(self.dir) else ())
+        else:
+            self.extractZip(plan)
+
+        if 'strings' not in plan:
+            self.strings = []
+
+        # NOTE an APK without code fails, so it is neither cached nor written
+        # out with empty features
+        if not self.dex_files:
+            raise FileNotFoundError('no classes.dex in %s' % (self.file))
+
+    # Find DEX files and read string resources (if in plan) straight from the
+    # APK archive
+    # Raises zipfile.BadZipFile or OSError if the APK cannot be read
+    # NOTE DEX files are read from the archive by each DexAnalyzer
+    def extractZip(self, plan):
+
+        verb('extract', 'reading %s ...' % (self.file))
+
+        with zipfile.ZipFile(self.file) as apk:
+            names = set(apk.namelist())
+
+            self.dex_files = dexFiles(names)
+
+            if 'strings' not in plan:
+                self.strings = []
+            elif 'resources.arsc' in names:
+                self.strings = ArscParser(apk.read('resources.arsc'),
+                        os.path.join(self.file, 'resources.arsc')).strings
+            else:
+                self.strings = []
+
+    # Extract/decrypt the parts of APK file in plan using `apktool`
+    def extractApktool(self, plan):
+
+        verb('extract', 'extracting %s to %s ...' % (self.file, self.dir))
+
+        # Fork command
+        with subprocess.Popen(apktoolCommand(self.file, self.dir,
+                apktoolOptions(plan)),
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE) as proc:
+
+            # Wait for command completion
+            proc.wait()
+
+            # If the process exited with errors, print its output
+            if proc.returncode != 0:
+                error('extract', 'encountered errors for %s' % (self.file))
+                error('extract', '\n%s' % (proc.stderr.read().decode()) )
+            else:
+                verb('extract', 'extraction completed successfuly')
+    
+    # Remove extracted directory
+    def remove(self):
+        if settings.EXTRACT_BACKEND != 'apktool':
+            return
+        verb('remove', 'delete extracted directory %s' % (self.dir))
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    # Return a DexAnalyzer for each DEX file
+    def getDexAnalyzers(self):
+
+        if settings.EXTRACT_BACKEND == 'apktool':
+            return [ DexAnalyzer(self.file, name, os.path.join(self.dir, name))
+                    for name in self.dex_files ]
+        return [ DexAnalyzer(self.file, name) for name in self.dex_files ]
+
+    # Analyze all DEX files and merge their features
+    # DEX files are analyzed in parallel by up to settings.DEX_WORKERS
+    # processes, unless this is already a pool worker
+    # NOTE scheduler workers are daemonic and cannot fork, so with
+    # settings.PARALLEL the DEX files are always analyzed one after another
+    def getDexFeatures(self):
+
+        dexes = self.getDexAnalyzers()
+
+        if (len(dexes) > 1 and settings.DEX_WORKERS > 1 and
+                not current_process().daemon):
+            with Pool(min(settings.DEX_WORKERS, len(dexes))) as pool:
+                dexes = pool.map(runDex, dexes)
+        else:
+            dexes = [ dex.run() for dex in dexes ]
+
+        # NOTE merged in DEX file order, as if all code was in one DEX file
+        op_ngrams = {}
+        for dex in dexes:
+            self.vector.update(dex.vector)
+            if dex.code_sketch is not None:
+                if self.sketch is None:
+                    self.sketch = ngramSketch()
+                self.sketch.merge(dex.code_sketch)
+            else:
+                data.updateOccurrences(self.code_ngrams, dex.code_ngrams)
+            for n, ngrams in dex.code_sweep.items():
+                data.updateOccurrences(self.code_sweep.setdefault(n, {}), ngrams)
+            data.updateOccurrences(op_ngrams, dex.op_ngrams)
+            self.method_hits += dex.method_hits
+            self.method_misses += dex.method_misses
+
+        if settings.OPCODE_NGRAMS:
+            self.op_ngrams = get_sparse_n_grams(op_ngrams)
+
+        verb('getDexFeatures', 'analyzed %d DEX files in %s' % (len(dexes),
+            self.file))
+
+    # Get features from bytecode
+    def getCodeFeatures(self):
+
+        self.vector.n_total_immediate_constants = self.vector.countOpcodes(
+                IMMEDIATE_LITERAL_MASK)
+        self.vector.n_total_unary_operators = self.vector.countOpcodes(
+                UNARY_OPERATOR_MASK)
+        self.vector.n_total_binary_operators = self.vector.countOpcodes(
+                BINARY_OPERATOR_MASK)
+
+    # Read string resources from the strings.xml decoded by apktool
+    def readStrings(self, path="res/values/strings.xml"):
+
+        path = os.path.join(self.dir, path)
+
+        if not os.path.exists(path):
+            error('get_n_grams', 'Path %s does not exist' % (path))
+            return
+
+        with open(path) as xml_file:
+            parser = BeautifulSoup(xml_file, features="lxml-xml")
+
+        strings = parser.findAll("string")
+
+        for i in range(len(strings)):
+            strings[i] = bytes(strings[i].text, encoding='utf-8')
+
+        self.strings = strings
+
+    def getNgramFeatures(self):
+
+        # NOTE the zip backend reads the strings in extract, and there is no
+        # strings.xml without apktool
+        if self.strings is None:
+            if settings.EXTRACT_BACKEND == 'apktool':
+                self.readStrings()
+            if self.strings is None:
+                return
+
+        strings = self.strings
+
+        if settings.NGRAM_SKETCH:
+            self.getSketchNgramFeatures(strings)
+            return
+
+        # Begin by parsing ngrams from `path`, of every length in one pass
+        ngrams = get_multi_n_grams(strings, (settings.NGRAM_SIZE,
+            *sweepSizes()))
+        self.ngrams = ngrams.pop(settings.NGRAM_SIZE)
+
+        # Next add ngrams from code sections
+        data.updateOccurrences(self.ngrams, self.code_ngrams)
+        for n, sweep in ngrams.items():
+            data.updateOccurrences(sweep, self.code_sweep.get(n, {}))
+            self.sweep_ngrams[n] = get_sparse_n_grams(sweep)
+
+        verb('getNgramFeatures', 'Successfully extracted %d ngrams' %
+                (len(self.ngrams)))
+
+    # Approximate the ngrams of strings and the code sections by their heavy
+    # hitters (settings.NGRAM_SKETCH)
+    def getSketchNgramFeatures(self, strings):
+
+        if self.sketch is None:
+            self.sketch = ngramSketch()
+        self.sketch.addStrings(strings)
+
+        self.ngrams = self.sketch.getHeavyHitters()
+        self.ngram_total = self.sketch.getTotal()
+
+        floor, cms_error = self.sketch.getErrors()
+        verb('getSketchNgramFeatures', '%d ngrams, %d heavy hitters, '
+                'counts over by at most %d (%.1f with p=%.3f)' % (
+                    self.ngram_total, len(self.ngrams), floor, cms_error,
+                    self.sketch.cms.confidence()))
+
+    # Add the top_n ngrams by TF-IDF to the feature vector, given the TF-IDF
+    # values of ngram ids
+    def getTfidfFeatures(self, ids, tfidfs, top_n=5):
+        # Store top 5 ngrams (ngram ids are numbers)
+        self.vector.top_ngrams = tuple(getTopNgrams(ids, tfidfs, top_n))
+        verb('getTfidfFeatures', self.vector.top_ngrams)
+
+    # Add the top_n opcode ngrams by TF-IDF to the feature vector, given the
+    # TF-IDF values of opcode ngram ids
+    def getOpcodeTfidfFeatures(self, ids, tfidfs, top_n=5):
+        self.vector.top_op_ngrams = tuple(getTopNgrams(ids, tfidfs, top_n))
+        verb('getOpcodeTfidfFeatures', self.vector.top_op_ngrams)
+
+    # Replace self.ngrams with arrays of ngram ids and occurrences, which are
+    # cheaper to send between processes and to spill to disk
+    def compact(self):
+        self.ngram_ids, self.ngram_counts = get_sparse_n_grams(self.ngrams)
+        self.ngrams = None
+
+    # Remove references to bulky objects to allow garbage collection
+    def clean(self):
+        del self.strings
+        del self.code_ngrams
+        del self.code_sweep
+        del self.sketch
 
     # Run entire analysis routine
     def run(self):
 
         try:
             self.extract()
-            self.loadDex()
-            self.getClassFeatures()
+            self.getDexFeatures()
             self.getNgramFeatures()
             self.getCodeFeatures()
             self.clean()
@@ -237,6 +591,27 @@ class ApkAnalyzer:
         return self
 
 
+# Run a DexAnalyzer (can't use a lambda since it breaks multiprocessing)
+def runDex(dex):
+    return dex.run()
+
+# Run an ApkAnalyzer on the apk file of task (file, sha256, directory, size)
+# in a pool worker, where size is the number of bytes an Extractor extracted
+# to directory (None if the APK is extracted by the worker)
+# NOTE in streaming mode only compacted ngrams are sent back to the parent, and
+# with settings.SHARED_RESULTS their arrays are sent in shared memory
+def runApk(task):
+    apk_file, sha256, directory, size = task
+    apk = ApkAnalyzer(apk_file, directory)
+    apk.sha256 = sha256
+    apk.extracted = size is not None
+    apk.run()
+    if settings.STREAM and not settings.NGRAM_SKETCH:
+        apk.compact()
+    if settings.SHARED_RESULTS:
+        share(apk, ApkAnalyzer.SHARED)
+    return apk
+
 # Object for parsing/labeling a set of Apks (performs TF-IDF analysis)
 class ApkSet:
 
@@ -246,68 +621,356 @@ class ApkSet:
         self.apks = []
         self.n_apks = 0
         self.exclude = exclude
-    
+        self.spill_file = None          # Spilled ngrams (streaming mode)
+        self.doc_freq = Counter()       # Number of apks with each ngram id (streaming mode)
+        self.op_doc_freq = Counter()    # Number of apks with each opcode ngram id (streaming mode)
+        self.failed = {}                # { apk file : reason } of apks killed or failed in workers
+        self.scratch = None             # Scratch directory APKs are extracted to
+
     # Enumerate all APK files
-    def enumApks(self):
+    # If a FeatureCache is given, APKs found in it are loaded and finished
+    # NOTE APKs are extracted to the scratch directory, which removes the
+    # directories of killed runs itself, so nothing in the corpus is removed
+    def enumApks(self, cache=None):
 
         for base, dirs, files in os.walk(self.directory):
             # Restrict to .apk extension
             files = [f for f in files if os.path.splitext(f)[1] == '.apk' and
                     os.path.join(base, f) not in self.exclude]
             for f in files:
-                self.apks.append(ApkAnalyzer(os.path.join(base,f)))
+                apk_file = os.path.join(base, f)
+                self.apks.append(ApkAnalyzer(apk_file, self.scratch and
+                        self.scratch.path(apk_file)))
 
         self.n_apks = len(self.apks)
 
+        if cache is not None:
+            for apk in self.apks:
+                apk.sha256 = fileHash(apk.file)
+                if cache.get(apk) and self.spill_file is not None:
+                    self.spill(apk)
+            verb('enumApks', '%d of %d apks found in cache' % (cache.hits,
+                self.n_apks))
+
 
     # Calculate Tf-Idf features
     def getTfidfFeatures(self):
 
-        ngram_docs = {}
-
-        # Calculate parts of TF-IDF values (overwrites occurrences in apk.ngrams)
+        # Document-term matrix with one row of ngram counts per apk
+        matrix = NgramMatrix()
         for apk in self.apks:
-            total = sum(apk.ngrams.values())
-            for ngram in apk.ngrams:
-                # Compute TF term for ngram
-                apk.ngrams[ngram] /= total
-                # Compute number of documents with ngram in it
-                if ngram in ngram_docs:
-                    ngram_docs[ngram] += 1
-                else:
-                    ngram_docs[ngram] = 1
+            matrix.addRow(apk.ngrams, apk.ngrams.values())
 
-        # Calculate IDFs (overwrites TFs in apk.ngrams)
-        log_total_docs = math.log(self.n_apks)
+        idf = getIdf(matrix.docFreq(), self.n_apks)
+        for row, apk in enumerate(self.apks):
+            ids, counts = matrix.row(row)
+            apk.getTfidfFeatures(ids, getTfidf(ids, counts, idf))
+
+    # Spill the ngrams of apk to self.spill_file and count the apks each
+    # ngram occurs in
+    def spill(self, apk):
+
+        if apk.ngrams is not None:
+            apk.compact()
+
+        # NOTE ngram ids of an apk are distinct
+        self.doc_freq.update(apk.ngram_ids)
+
+        apk.spill_offset = self.spill_file.tell()
+        pickle.dump((apk.ngram_ids, apk.ngram_counts),
+                self.spill_file, pickle.HIGHEST_PROTOCOL)
+        apk.ngram_ids = None
+        apk.ngram_counts = None
+
+        if apk.op_ngrams is not None:
+            self.op_doc_freq.update(apk.op_ngrams[0])
+            apk.op_spill_offset = self.spill_file.tell()
+            pickle.dump(apk.op_ngrams, self.spill_file, pickle.HIGHEST_PROTOCOL)
+            apk.op_ngrams = None
+
+    # Calculate Tf-Idf features from the spilled ngrams (streaming mode)
+    # NOTE only one apk's ngrams are in memory at a time
+    def getSpilledTfidfFeatures(self):
+
+        idf = getIdf(self.doc_freq, self.n_apks)
+        for apk in self.apks:
+            if apk.spill_offset is None:
+                continue
+
+            self.spill_file.seek(apk.spill_offset)
+            ids, counts = pickle.load(self.spill_file)
+            apk.getTfidfFeatures(ids, getTfidf(ids, counts, idf))
+
+    # Return the opcode ngram (ids, counts) of apk, from the spill file if
+    # they were spilled
+    def getOpcodeNgrams(self, apk):
+
+        if apk.op_spill_offset is None:
+            return apk.op_ngrams
+        self.spill_file.seek(apk.op_spill_offset)
+        return pickle.load(self.spill_file)
+
+    # Calculate Tf-Idf features of the opcode ngrams (settings.OPCODE_NGRAMS)
+    # NOTE opcode ngrams are always computed over the apks of this run, as
+    # they are not in the TF-IDF model (settings.TFIDF_MODEL)
+    def getOpcodeTfidfFeatures(self):
+
+        if settings.TFIDF_MODEL is not None:
+            warn('getOpcodeTfidfFeatures', 'opcode ngrams are not in the '
+                    'TF-IDF model, so they are ranked over the %d apks of '
+                    'this run only' % (self.n_apks))
+
+        apks = [apk for apk in self.apks if apk.finished]
+
+        if self.spill_file is None:
+            self.op_doc_freq = Counter()
+            for apk in apks:
+                self.op_doc_freq.update(apk.op_ngrams[0])
+
+        idf = getIdf(self.op_doc_freq, self.n_apks)
+        for apk in apks:
+            ids, counts = self.getOpcodeNgrams(apk)
+            apk.getOpcodeTfidfFeatures(ids, getTfidf(ids, counts, idf))
+
+    # Calculate approximate Tf-Idf features from the heavy hitters of the apks
+    # (settings.NGRAM_SKETCH)
+    # NOTE document frequencies are estimated with a CountMinSketch of the
+    # heavy hitters of every apk, so an ngram only counts towards them in the
+    # apks it is frequent in
+    def getSketchTfidfFeatures(self):
+
+        apks = [apk for apk in self.apks if apk.finished]
+
+        doc_freq = CountMinSketch(settings.SKETCH_DOC_WIDTH,
+                settings.SKETCH_DEPTH)
+        for apk in apks:
+            doc_freq.update(dict.fromkeys(apk.ngrams, 1))
+
+        for apk in apks:
+            ids = list(apk.ngrams)
+            idf = getIdf(getSketchDocFreq(doc_freq, ids, self.n_apks),
+                    self.n_apks)
+            apk.getTfidfFeatures(ids, getTfidf(ids, apk.ngrams.values(), idf,
+                apk.ngram_total))
+
+    # Yield (file, content hash, ngram ids, ngram counts) of the finished
+    # apks that are not in model with the same content
+    def getNgramRows(self, model):
+
+        hashes = model.hashes()
         for apk in self.apks:
-            for ngram in apk.ngrams:
-                apk.ngrams[ngram] *= log_total_docs - math.log(ngram_docs[ngram])
-            apk.getTfidfFeatures()
+            if not apk.finished:
+                continue
+            sha256 = apk.sha256 or fileHash(apk.file)
+            if hashes.get(apk.file) == sha256:
+                continue
+            if apk.spill_offset is not None:
+                self.spill_file.seek(apk.spill_offset)
+                ids, counts = pickle.load(self.spill_file)
+            else:
+                ids, counts = get_sparse_n_grams(apk.ngrams)
+            yield apk.file, sha256, ids, counts
 
-    # Can't use a lambda since it breaks multiprocessing
-    def _run(self, apk):
-        return apk.run()
+    # Calculate Tf-Idf features with the persisted TF-IDF model, whose corpus
+    # is every apk added to it so far
+    # NOTE apks already in the model with the same content are not added
+    # again
+    def getModelTfidfFeatures(self):
+
+        model = TfidfModel(settings.TFIDF_MODEL, modelKey())
+        try:
+            model.add(self.getNgramRows(model))
+            for apk in self.apks:
+                top = model.top(apk.file)
+                if top is not None:
+                    apk.vector.top_ngrams = top
+        finally:
+            model.close()
+
+    # Journal a finished apk, store it in the cache and spill its ngrams
+    # (streaming mode)
+    def collect(self, apk, cache, journal=None):
+
+        if journal is not None and apk.finished:
+            stat = os.stat(apk.file)
+            journal.append((apk.file, stat.st_size, stat.st_mtime_ns, apk))
+        if cache is not None and apk.finished:
+            cache.put(apk)
+        apk.sweep_ngrams = {}
+        if self.spill_file is not None:
+            self.spill(apk)
+
+    # Replace unfinished apks by the apks finished in the journal, unless
+    # their files changed since
+    def replay(self, journal, cache):
+
+        finished = { apk_file : (size, mtime, apk) for apk_file, size, mtime,
+                apk in journal.records }
+
+        hits = 0
+        for i, apk in enumerate(self.apks):
+            if apk.finished or apk.file not in finished:
+                continue
+            size, mtime, journaled = finished[apk.file]
+            stat = os.stat(apk.file)
+            if (stat.st_size, stat.st_mtime_ns) == (size, mtime):
+                self.apks[i] = journaled
+                self.collect(journaled, cache)
+                hits += 1
+        verb('replay', '%d of %d apks found in journal' % (hits, self.n_apks))
 
     # Run author-apk
+    # NOTE the journal is removed once the run is complete
     def run(self):
 
-        self.enumApks()
+        # NOTE heavy hitters are small, so they are never spilled
+        if settings.STREAM and not settings.NGRAM_SKETCH:
+            self.spill_file = tempfile.TemporaryFile(prefix='apkset-',
+                    dir=settings.SPILL_DIR)
+            self.doc_freq = Counter()
+            self.op_doc_freq = Counter()
 
-        if settings.PARALLEL:
-            new_apks = []
-            try:
-                with Pool(settings.N_THREADS) as pool:
-                    itr = pool.imap_unordered(self._run, self.apks)
-                    for i in itr:
-                        new_apks.append(i)
-            finally:
-                self.apks = new_apks
-        else:
-            for apk in self.apks:
-                apk.run()
+        journal = None
+        if settings.JOURNAL is not None:
+            journal = Journal(settings.JOURNAL, journalKey(),
+                    settings.JOURNAL_SYNC)
+
+        try:
+            self.analyze(journal)
+
+            if self.n_apks > 0:
+                if settings.NGRAM_SKETCH:
+                    self.getSketchTfidfFeatures()
+                elif settings.TFIDF_MODEL is not None:
+                    self.getModelTfidfFeatures()
+                elif settings.STREAM:
+                    self.getSpilledTfidfFeatures()
+                else:
+                    self.getTfidfFeatures()
+                if settings.OPCODE_NGRAMS:
+                    self.getOpcodeTfidfFeatures()
+            if journal is not None:
+                journal.remove()
+        finally:
+            if journal is not None:
+                journal.close()
+            if self.spill_file is not None:
+                self.spill_file.close()
+                self.spill_file = None
+
+    # Analyze all apks that are not in the cache or journal
+    def analyze(self, journal=None):
+
+        # NOTE the feature cache holds exact ngrams of strings and bytecode,
+        # so it is not used for heavy hitters or without string ngrams
+        cache = None
+        if (settings.FEATURE_CACHE is not None and not settings.NGRAM_SKETCH
+                and settings.STRING_NGRAMS):
+            cache = FeatureCache(settings.FEATURE_CACHE,
+                    settings.EXTRACT_BACKEND, sweepSizes(),
+                    settings.OPCODE_NGRAMS)
+
+        # NOTE the zip backend reads APKs in memory, so only apktool needs a
+        # scratch directory
+        if settings.EXTRACT_BACKEND == 'apktool':
+            self.scratch = Scratch(settings.SCRATCH_DIR,
+                    settings.SCRATCH_BUDGET)
 
-        if self.n_apks > 0:
-            self.getTfidfFeatures()
+        try:
+            self.enumApks(cache)
+            if journal is not None:
+                self.replay(journal, cache)
+
+            # Only analyze APKs that were not found in the cache
+            cached = [apk for apk in self.apks if apk.finished]
+            apks = [apk for apk in self.apks if not apk.finished]
+
+            # NOTE failed apks are kept unfinished, so they count towards
+            # n_apks like apks that could not be read
+            if settings.PARALLEL:
+                new_apks = []
+                shared = 0
+                attach_time = 0.0
+                size = lambda task: os.path.getsize(task[0])
+
+                # Release the scratch bytes of extracted tasks, removing the
+                # directories of those whose worker was killed
+                def cleanup(task):
+                    if task[3] is not None:
+                        self.scratch.remove(task[2], task[3])
+
+                scheduler = Scheduler(runApk, settings.N_THREADS,
+                        settings.TASK_TIMEOUT, settings.WORKER_MEMORY,
+                        cleanup)
+                tasks = { apk.file : apk for apk in apks }    # Apks not returned
+                if settings.SHARED_RESULTS:
+                    track()
+
+                # With apktool, APKs are extracted ahead of the workers and
+                # fed to them as they are extracted
+                extractor = None
+                feed = None
+                queued = [ (apk.file, apk.sha256, apk.dir, None) for apk in
+                        apks ]
+                if settings.EXTRACT_BACKEND == 'apktool':
+                    extractor = Extractor([ ((apk.file, apk.sha256, apk.dir),
+                            apk.file, apk.dir) for apk in sorted(apks,
+                            key=lambda apk: os.path.getsize(apk.file),
+                            reverse=True) ], settings.EXTRACT_CONCURRENCY,
+                            settings.EXTRACT_BACKLOG, settings.TASK_TIMEOUT,
+                            apktoolOptions(extractionPlan()),
+                            settings.APKTOOL_SERVER, self.scratch)
+                    feed = extractor.start()
+                    queued = []
+
+                # NOTE a finished extraction is waited for, so its failures
+                # are not lost
+                stop_timeout = 0
+                try:
+                    for i in scheduler.run(queued, size, lambda task: task[0],
+                            feed, len(apks)):
+                        start = time.process_time()
+                        shared += attach(i, ApkAnalyzer.SHARED)
+                        attach_time += time.process_time() - start
+                        new_apks.append(i)
+                        del tasks[i.file]
+                        self.collect(i, cache, journal)
+                    stop_timeout = Extractor.STOP_TIMEOUT
+                finally:
+                    failed = list(scheduler.failed)
+                    if extractor is not None:
+                        extractor.stop(stop_timeout)
+                        failed += extractor.failed
+                    self.failed.update((task[0], reason) for task, reason in
+                            failed)
+                    self.apks = cached + new_apks + list(tasks.values())
+                    verb('analyze', '%.1f MB of results in shared memory, '
+                            'attached in %.2f s CPU' % (shared / (1 << 20),
+                            attach_time))
+            else:
+                # NOTE like in a pool worker, an exception fails the apk
+                # instead of the run
+                for apk in apks:
+                    try:
+                        apk.run()
+                    except Exception as e:
+                        self.failed[apk.file] = '%s: %s' % (type(e).__name__,
+                                e)
+                        error('analyze', '%s failed: %s' % (apk.file,
+                                self.failed[apk.file]))
+                        continue
+                    self.collect(apk, cache, journal)
+        finally:
+            if cache is not None:
+                cache.close()
+            if self.scratch is not None:
+                self.scratch.close()
+                self.scratch = None
+
+        if settings.METHOD_CACHE is not None:
+            verb('run', 'method cache: %d hits, %d misses' % (
+                sum(apk.method_hits for apk in self.apks),
+                sum(apk.method_misses for apk in self.apks)))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,191 @@
+#!/usr/bin/python3
+#
+# apktoolpool.py: pool of long-lived apktool processes (ApktoolServer.java)
+#
+
+import asyncio
+from message import *
+import os
+import settings
+import subprocess
+import time
+
+# Driver run by every apktool process
+DRIVER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        'ApktoolServer.java')
+
+# Return the command starting an apktool process
+def serverCommand():
+    return ['java', '-cp', settings.APKTOOL_JAR, DRIVER]
+
+# Return the p-th percentile (0 to 100) of sorted values
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+# Object for one apktool process, answering requests over stdin/stdout
+class ApktoolServer:
+
+    def __init__(self, index):
+
+        self.index = index
+        self.proc = None
+        self.requests = 0       # Requests since the process was started
+        self.last_used = 0.0    # Time of the last reply
+
+    async def start(self):
+
+        self.proc = await asyncio.create_subprocess_exec(*serverCommand(),
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL)
+        self.requests = 0
+        if await self.request(('ping',), ApktoolPool.START_TIMEOUT) != [
+                'pong']:
+            raise ConnectionError('apktool process did not start')
+
+    # Send a request and return the fields of its reply
+    # Raises ConnectionError if the process is gone and asyncio.TimeoutError
+    # if it does not reply in timeout seconds
+    async def request(self, fields, timeout=None):
+
+        if self.proc is None or self.proc.returncode is not None:
+            raise ConnectionError('apktool process exited')
+        self.proc.stdin.write(('\t'.join(fields) + '\n').encode())
+        await self.proc.stdin.drain()
+        line = await asyncio.wait_for(self.proc.stdout.readline(), timeout)
+        if not line:
+            raise ConnectionError('apktool process exited with code %s' % (
+                    await self.proc.wait()))
+        self.requests += 1
+        self.last_used = time.monotonic()
+        return line.decode().rstrip('\n').split('\t')
+
+    # Return whether the process answers a ping
+    async def healthy(self):
+
+        try:
+            return await self.request(('ping',),
+                    ApktoolPool.PING_TIMEOUT) == ['pong']
+        except (ConnectionError, OSError, asyncio.TimeoutError):
+            return False
+
+    async def stop(self):
+
+        if self.proc is not None and self.proc.returncode is None:
+            self.proc.kill()
+            await self.proc.wait()
+        self.proc = None
+
+    async def restart(self):
+
+        await self.stop()
+        await self.start()
+
+
+# Object for a pool of apktool processes that extract APKs without starting
+# a JVM (and loading apktool) for each one
+#
+# Idle processes are pinged every HEALTH_INTERVAL seconds. A process that
+# does not answer, exits, or times out on an extraction is restarted, and
+# every process is restarted after max_requests extractions so the JVM does
+# not grow without bound. Extraction latencies are kept for percentiles.
+class ApktoolPool:
+
+    # Seconds allowed for a JVM to start and answer its first ping
+    START_TIMEOUT = 60
+
+    # Seconds allowed to answer a ping
+    PING_TIMEOUT = 10
+
+    # Seconds between health checks of idle processes
+    HEALTH_INTERVAL = 30
+
+    def __init__(self, size, timeout=None, max_requests=None):
+
+        self.size = size
+        self.timeout = timeout          # Seconds per extraction (None for no limit)
+        self.max_requests = max_requests
+        self.servers = [ ApktoolServer(i) for i in range(size) ]
+        self.idle = asyncio.Queue()
+        self.latencies = []             # Seconds per extraction
+        self.restarts = 0
+        self.health = None
+
+    async def start(self):
+
+        await asyncio.gather(*(server.start() for server in self.servers))
+        for server in self.servers:
+            self.idle.put_nowait(server)
+        self.health = asyncio.create_task(self.checkHealth())
+        verb('ApktoolPool', 'started %d apktool processes' % (self.size))
+
+    # Extract apk_file to directory with apktool options (see
+    # extractor.apktoolOptions) and return why it failed (None if it did not)
+    async def extract(self, apk_file, directory, options=()):
+
+        server = await self.idle.get()
+        try:
+            if (server.proc is None or server.proc.returncode is not None or
+                    self.max_requests is not None and
+                    server.requests >= self.max_requests):
+                await self.restart(server)
+
+            start = time.monotonic()
+            try:
+                reply = await server.request(('d', apk_file, directory,
+                        *options), self.timeout)
+            except asyncio.TimeoutError:
+                await self.restart(server)
+                return 'apktool timed out after %d s' % (self.timeout)
+            except (ConnectionError, OSError) as e:
+                await self.restart(server)
+                return str(e)
+            self.latencies.append(time.monotonic() - start)
+
+            if reply[0] != 'ok':
+                return reply[-1]
+            return None
+        finally:
+            self.idle.put_nowait(server)
+
+    # Restart a process, counting it
+    async def restart(self, server):
+
+        self.restarts += 1
+        try:
+            await server.restart()
+        except (ConnectionError, OSError, asyncio.TimeoutError) as e:
+            error('ApktoolPool', 'cannot restart apktool process %d: %s' % (
+                    server.index, e))
+
+    # Ping idle processes every HEALTH_INTERVAL seconds and restart those
+    # that do not answer
+    async def checkHealth(self):
+
+        while True:
+            await asyncio.sleep(ApktoolPool.HEALTH_INTERVAL)
+            for i in range(self.idle.qsize()):
+                server = self.idle.get_nowait()
+                try:
+                    if (time.monotonic() - server.last_used >=
+                            ApktoolPool.HEALTH_INTERVAL and
+                            not await server.healthy()):
+                        warn('ApktoolPool', 'apktool process %d is not '
+                                'responding, restarting it' % (server.index))
+                        await self.restart(server)
+                finally:
+                    self.idle.put_nowait(server)
+
+    # Stop all processes and print latency percentiles
+    async def close(self):
+
+        if self.health is not None:
+            self.health.cancel()
+        await asyncio.gather(*(server.stop() for server in self.servers))
+
+        latencies = sorted(self.latencies)
+        if latencies:
+            verb('ApktoolPool', '%d extractions, %d restarts, latency p50 '
+                    '%.2f s, p90 %.2f s, p99 %.2f s, max %.2f s' % (
+                    len(latencies), self.restarts, percentile(latencies, 50),
+                    percentile(latencies, 90), percentile(latencies, 99),
+                    latencies[-1]))
@@ -0,0 +1,469 @@
+#!/usr/bin/python3
+#
+# bench.py: benchmarks for the feature extraction pipeline
+#
+
+from analysis import ApkAnalyzer
+from CodeParser import CodeParser, opcodeStream
+from DexParser import DexBuffer, DexParser
+import io
+import math
+from message import *
+from ngrams import get_multi_n_grams, get_n_grams, get_opcode_n_grams
+import random
+from scratch import Scratch, treeSize
+import settings
+import shutil
+from sketch import CountMinSketch, NgramSketch, getSketchDocFreq
+import time
+import tracemalloc
+from tfidf import NgramMatrix, getIdf, getTfidf, getTopNgrams
+
+# Time a function call, returns (result, seconds) of the best of `repeat` runs
+# NOTE verbose output is disabled while timing
+def timeit(func, *args, repeat=3):
+    best = None
+    verbose = settings.VERBOSE
+    settings.VERBOSE = False
+    try:
+        for i in range(repeat):
+            start = time.perf_counter()
+            result = func(*args)
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+    finally:
+        settings.VERBOSE = verbose
+    return result, best
+
+# Collect the bytecode of every method in a dex file
+def getBytecode(dex):
+    bytecode = []
+    for cls in dex.class_defs:
+        if cls.class_data is not None:
+            for m in cls.class_data.direct_methods + cls.class_data.virtual_methods:
+                if m.code is not None:
+                    bytecode.append(m.code.insns)
+    return bytecode
+
+# Compare the table-driven instruction decoder to the big-int decoder
+def benchCodeParser(dex_path):
+    dex = DexParser(dex_path)
+    bytecode = getBytecode(dex)
+    size = sum(len(b) for b in bytecode)
+    verb('benchCodeParser', '%d methods, %d bytes of bytecode' %
+            (len(bytecode), size))
+
+    parse = lambda legacy: [ CodeParser(b, dex.header.VERSION, legacy)
+            for b in bytecode ]
+    table, t_table = timeit(parse, False)
+    legacy, t_legacy = timeit(parse, True)
+
+    for t, l in zip(table, legacy):
+        if format(t) != format(l):
+            error('benchCodeParser', 'decoders disagree: %s != %s' % (t, l))
+            break
+
+    verb('benchCodeParser', 'int decoder:   %.3fs' % (t_legacy))
+    verb('benchCodeParser', 'table decoder: %.3fs (%.1fx)' %
+            (t_table, t_legacy / t_table))
+
+# Compare parsing a DEX file with reads, memory-mapped and from memory
+def benchDexParser(dex_path):
+    with open(dex_path, 'rb') as dex_file:
+        buffer = dex_file.read()
+    verb('benchDexParser', '%s: %d bytes' % (dex_path, len(buffer)))
+
+    for mode in ('read', 'mmap', 'buffer'):
+        settings.DEX_MMAP = (mode == 'mmap')
+        if mode == 'buffer':
+            dex, t = timeit(DexParser, dex_path, buffer, False)
+        else:
+            dex, t = timeit(DexParser, dex_path, None, False)
+        verb('benchDexParser', '%s: %.3fs' % (mode, t))
+
+    dex.reportStats()
+
+    # Lazy parsing of the header only, class_data counts and access flags
+    counts = lambda: [ c.class_data.direct_methods_size for c in
+            DexParser(dex_path, buffer, True).class_defs if c.class_data ]
+    flags = lambda: [ m.access_flags for c in
+            DexParser(dex_path, buffer, True).class_defs if c.class_data
+            for m in c.class_data.direct_methods ]
+    for name, func in (('header', lambda: DexParser(dex_path, buffer, True)),
+            ('counts', counts), ('flags', flags)):
+        result, t = timeit(func)
+        verb('benchDexParser', 'lazy %s: %.3fs' % (name, t))
+
+# Encode value as unsigned LEB128
+def uleb128(value):
+    data = bytearray()
+    while value >= 0x80:
+        data.append((value & 0x7f) | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+# Compare LEB128 decoders on encoded_field-like (small) and
+# encoded_method-like (index, flags, code offset) values
+def benchLeb128(n='300000'):
+    n = int(n)
+    rand = random.Random(0)
+    runs = {
+        'fields' : [ v for i in range(n // 2) for v in
+            (rand.randrange(4), rand.choice((0x1, 0x9, 0x19))) ],
+        'methods' : [ v for i in range(n // 3) for v in
+            (rand.randrange(4), rand.choice((0x1, 0x2, 0x10001)),
+                rand.randrange(1 << 22)) ],
+    }
+
+    for name, values in runs.items():
+        data = b''.join(uleb128(v) for v in values)
+        n_values = len(values)
+
+        decoders = {
+            'per-byte' : lambda: [ DexParser.parseLeb128(f) for f in
+                (io.BytesIO(data),) for i in range(n_values) ],
+            'buffer' : lambda: [ b.readLeb128() for b in (DexBuffer(data),)
+                for i in range(n_values) ],
+            'leb128s' : lambda: DexParser.leb128s(data, 0, n_values)[0],
+            'leb128Runs' : lambda: DexParser.leb128Runs(data, 0, n_values)[0],
+        }
+
+        base = None
+        for decoder, func in decoders.items():
+            result, t = timeit(func)
+            if list(result) != values:
+                error('benchLeb128', '%s decoded wrong values' % (decoder))
+            base = base or t
+            verb('benchLeb128', '%s %-10s %.3fs (%.1fx)' % (name, decoder, t,
+                base / t))
+
+# Compare per-APK latency and disk writes of the extraction backends (extract,
+# load DEX and read string resources), extracting everything and only what
+# the enabled features read (settings.EXTRACT_PLAN)
+def benchExtract(*apk_paths):
+    backends = ['zip']
+    if shutil.which('apktool') is not None:
+        backends.append('apktool')
+    else:
+        warn('benchExtract', 'apktool not found, only timing zip backend')
+
+    backend, plan = settings.EXTRACT_BACKEND, settings.EXTRACT_PLAN
+    scratch = Scratch(settings.SCRATCH_DIR)
+    try:
+        for settings.EXTRACT_BACKEND in backends:
+            for settings.EXTRACT_PLAN in (False, True):
+                times = []
+                written = 0
+                for path in apk_paths:
+                    apk = ApkAnalyzer(path, scratch.path(path))
+                    start = time.perf_counter()
+                    try:
+                        apk.extract()
+                        written += treeSize(apk.dir)
+                        for dex in apk.getDexAnalyzers():
+                            dex.loadDex()
+                        if apk.strings is None:
+                            apk.readStrings()
+                    finally:
+                        apk.remove()
+                    times.append(time.perf_counter() - start)
+
+                verb('benchExtract', '%s %s: %.3fs/apk mean, %.3fs max, '
+                        '%d KiB/apk written over %d apks' % (
+                        settings.EXTRACT_BACKEND, 'planned' if
+                        settings.EXTRACT_PLAN else 'full', sum(times) /
+                        len(times), max(times), written / len(times) / 1024,
+                        len(times)))
+    finally:
+        settings.EXTRACT_BACKEND, settings.EXTRACT_PLAN = backend, plan
+        scratch.close()
+
+# Compare analyzing the DEX files of a multidex APK one after another and in
+# parallel with settings.DEX_WORKERS processes
+def benchMultidex(apk_path, workers=None):
+    workers = int(workers or settings.DEX_WORKERS)
+
+    # NOTE the method cache would turn every run after the first into lookups
+    settings.METHOD_CACHE = None
+
+    def analyze():
+        apk = ApkAnalyzer(apk_path)
+        apk.extract()
+        apk.getDexFeatures()
+        return apk
+
+    results = {}
+    times = {}
+    for n in (1, workers):
+        settings.DEX_WORKERS = n
+        apk, times[n] = timeit(analyze)
+        results[n] = (apk.vector.getCounts(), list(apk.vector.opcodes),
+                apk.code_ngrams)
+        verb('benchMultidex', '%d DEX files, %d workers: %.3fs' %
+                (len(apk.dex_files), n, times[n]))
+
+    if results[1] != results[workers]:
+        error('benchMultidex', 'parallel and serial features differ')
+    verb('benchMultidex', 'speedup: %.1fx' % (times[1] / times[workers]))
+
+# Count ngrams by slicing every window (reference for benchNgrams)
+def sliceNgrams(strings, n=3):
+    dictionary = {}
+    for string in strings:
+        string = bytes(string)
+        for i in range(len(string) - n + 1):
+            key = int.from_bytes(string[i:i+n], 'little')
+            if key in dictionary:
+                dictionary[key] += 1
+            else:
+                dictionary[key] = 1
+    return dictionary
+
+# Compare ngram counting by slicing to counting packed ngram ids
+def benchNgrams(dex_path, n='3'):
+    n = int(n)
+    bytecode = getBytecode(DexParser(dex_path))
+    verb('benchNgrams', '%d methods, %d bytes of bytecode' %
+            (len(bytecode), sum(len(b) for b in bytecode)))
+
+    sliced, t_slice = timeit(sliceNgrams, bytecode, n)
+    packed, t_packed = timeit(get_n_grams, bytecode, n)
+
+    if sliced != packed or list(sliced) != list(packed):
+        error('benchNgrams', 'ngram counts differ')
+
+    verb('benchNgrams', 'slice:  %.3fs' % (t_slice))
+    verb('benchNgrams', 'packed: %.3fs (%.1fx)' % (t_packed,
+        t_slice / t_packed))
+
+# Compare counting ngrams of several lengths one length at a time to counting
+# them in one pass
+def benchSweep(dex_path, sizes='2,3,4,6'):
+    sizes = [ int(n) for n in sizes.split(',') ]
+    bytecode = getBytecode(DexParser(dex_path))
+    verb('benchSweep', '%d methods, %d bytes of bytecode, n in %s' %
+            (len(bytecode), sum(len(b) for b in bytecode), sizes))
+
+    separate, t_separate = timeit(lambda: { n : get_n_grams(bytecode, n) for
+        n in sizes })
+    single, t_single = timeit(get_multi_n_grams, bytecode, sizes)
+
+    for n in sizes:
+        if separate[n] != single[n] or list(separate[n]) != list(single[n]):
+            error('benchSweep', '%d-gram counts differ' % (n))
+
+    verb('benchSweep', 'separate: %.3fs' % (t_separate))
+    verb('benchSweep', 'one pass: %.3fs (%.1fx)' % (t_single,
+        t_separate / t_single))
+
+# Compare the vocabulary of byte ngrams to that of opcode ngrams (n = 1 to 4)
+# and the time to count them and to compute their TF-IDF over copies of the
+# bytecode split into documents
+def benchOpcodeNgrams(dex_path, n_docs='20'):
+    n_docs = int(n_docs)
+    bytecode = getBytecode(DexParser(dex_path))
+    docs = [ bytecode[i::n_docs] for i in range(n_docs) ]
+    verb('benchOpcodeNgrams', '%d methods, %d bytes of bytecode, %d documents' %
+            (len(bytecode), sum(len(b) for b in bytecode), n_docs))
+
+    count_bytes = lambda: [ get_n_grams(doc, settings.NGRAM_SIZE) for doc in
+            docs ]
+    count_ops = lambda: [ get_opcode_n_grams(opcodeStream(b) for b in doc)
+            for doc in docs ]
+
+    for name, count in (('byte %d-grams' % (settings.NGRAM_SIZE), count_bytes),
+            ('opcode 1-4-grams', count_ops)):
+        counts, t_count = timeit(count)
+        top, t_tfidf = timeit(matrixTfidf, counts)
+        vocabulary = set()
+        for c in counts:
+            vocabulary.update(c)
+        verb('benchOpcodeNgrams', '%s: %d distinct, %.0f per document, '
+                'count %.3fs, TF-IDF %.3fs' % (name, len(vocabulary),
+                    sum(len(c) for c in counts) / n_docs, t_count, t_tfidf))
+
+# Compute top ngrams with per-ngram loops over dicts (reference for benchTfidf)
+def dictTfidf(docs, top_n=5):
+    ngram_docs = {}
+    tfidfs = [ dict(doc) for doc in docs ]
+    for doc in tfidfs:
+        total = sum(doc.values())
+        for ngram in doc:
+            doc[ngram] /= total
+            ngram_docs[ngram] = ngram_docs.get(ngram, 0) + 1
+    log_total_docs = math.log(len(docs))
+    for doc in tfidfs:
+        for ngram in doc:
+            doc[ngram] *= log_total_docs - math.log(ngram_docs[ngram])
+    return [ sorted(doc, key=doc.get, reverse=True)[:top_n] for doc in tfidfs ]
+
+# Compute top ngrams with the sparse TF-IDF engine
+def matrixTfidf(docs, top_n=5):
+    matrix = NgramMatrix()
+    for doc in docs:
+        matrix.addRow(doc, doc.values())
+    idf = getIdf(matrix.docFreq(), len(matrix))
+    top = []
+    for row in range(len(matrix)):
+        ids, counts = matrix.row(row)
+        top.append(getTopNgrams(ids, getTfidf(ids, counts, idf), top_n))
+    return top
+
+# Compare TF-IDF with dict loops to the sparse engine on random documents
+def benchTfidf(n_docs='500', n_ngrams='5000'):
+    n_docs, n_ngrams = int(n_docs), int(n_ngrams)
+    rand = random.Random(0)
+
+    # Skewed ngram ids and small counts, so there are many ties
+    docs = []
+    for i in range(n_docs):
+        doc = {}
+        for j in range(n_ngrams):
+            ngram = int(rand.paretovariate(0.5)) & 0xffffff
+            doc[ngram] = doc.get(ngram, 0) + 1
+        docs.append(doc)
+    verb('benchTfidf', '%d documents, %d ngrams' % (n_docs,
+        sum(len(doc) for doc in docs)))
+
+    dicts, t_dicts = timeit(dictTfidf, docs)
+    matrix, t_matrix = timeit(matrixTfidf, docs)
+
+    if dicts != matrix:
+        error('benchTfidf', 'top ngrams differ')
+
+    verb('benchTfidf', 'dicts:  %.3fs' % (t_dicts))
+    verb('benchTfidf', 'matrix: %.3fs (%.1fx)' % (t_matrix, t_dicts / t_matrix))
+
+# Return the peak memory allocated by a function call (in bytes)
+def peakMemory(func, *args):
+    tracemalloc.start()
+    try:
+        func(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+# Return documents of byte strings whose words are drawn from a Zipf
+# distribution, a third of them from a part of the vocabulary of each document
+def zipfDocs(n_docs, size, rand):
+    words = [ bytes(rand.randrange(256) for i in range(rand.randrange(2, 10)))
+            for j in range(200000) ]
+    docs = []
+    for i in range(n_docs):
+        offset = rand.randrange(len(words))
+        doc = []
+        length = 0
+        while length < size:
+            word = int(rand.paretovariate(0.5)) % len(words)
+            if rand.random() < 0.3:
+                word = (word + offset) % len(words)
+            doc.append(words[word])
+            length += len(words[word])
+        docs.append([ b' '.join(doc[j:j+64]) for j in range(0, len(doc), 64) ])
+    return docs
+
+# Compute top ngrams from exact counts, returns (tops, counts of every doc)
+def exactTopNgrams(docs, top_n=5):
+    counts = [ get_n_grams(doc, settings.NGRAM_SIZE) for doc in docs ]
+    return matrixTfidf(counts, top_n), counts
+
+# Compute top ngrams from the heavy hitters of NgramSketches, returns (tops,
+# sketches)
+def sketchTopNgrams(docs, top_n=5):
+    sketches = []
+    for doc in docs:
+        sketch = NgramSketch(settings.NGRAM_SIZE, settings.SKETCH_WIDTH,
+                settings.SKETCH_DEPTH, settings.HEAVY_HITTERS)
+        sketch.addStrings(doc)
+        sketches.append(sketch)
+
+    heavy = [ sketch.getHeavyHitters() for sketch in sketches ]
+    doc_freq = CountMinSketch(settings.SKETCH_DOC_WIDTH, settings.SKETCH_DEPTH)
+    for ngrams in heavy:
+        doc_freq.update(dict.fromkeys(ngrams, 1))
+
+    top = []
+    for ngrams, sketch in zip(heavy, sketches):
+        ids = list(ngrams)
+        idf = getIdf(getSketchDocFreq(doc_freq, ids, len(docs)), len(docs))
+        top.append(getTopNgrams(ids, getTfidf(ids, ngrams.values(), idf,
+            sketch.getTotal()), top_n))
+    return top, sketches
+
+# Compare top ngrams by TF-IDF from exact counts and from sketches
+# (settings.NGRAM_SKETCH) on documents with Zipf distributed words
+def benchSketch(n_docs='50', size='200000', k=None):
+    n_docs, size = int(n_docs), int(size)
+    if k is not None:
+        settings.HEAVY_HITTERS = int(k)
+    rand = random.Random(0)
+    docs = zipfDocs(n_docs, size, rand)
+
+    (exact, counts), t_exact = timeit(exactTopNgrams, docs, repeat=1)
+    (approx, sketches), t_sketch = timeit(sketchTopNgrams, docs, repeat=1)
+
+    # Check the error bounds of the heavy hitters against the exact counts
+    n_bound = 0
+    max_error = 0
+    for doc_counts, sketch in zip(counts, sketches):
+        floor, cms_error = sketch.getErrors()
+        for i, count in sketch.getHeavyHitters().items():
+            over = count - doc_counts.get(i, 0)
+            max_error = max(max_error, over)
+            if over < 0 or over > floor:
+                n_bound += 1
+        if floor > sketch.getTotal() / settings.HEAVY_HITTERS:
+            n_bound += 1
+    if n_bound:
+        error('benchSketch', '%d counts outside the error bounds' % (n_bound))
+
+    # Peak memory of counting the largest document
+    doc = max(docs, key=lambda doc: sum(len(s) for s in doc))
+    sketch = NgramSketch(settings.NGRAM_SIZE, settings.SKETCH_WIDTH,
+            settings.SKETCH_DEPTH, settings.HEAVY_HITTERS)
+    peak_exact = peakMemory(get_n_grams, doc, settings.NGRAM_SIZE)
+    peak_sketch = peakMemory(sketch.addStrings, doc)
+
+    top_n = len(exact[0])
+    recall = sum(len(set(e) & set(a)) for e, a in zip(exact, approx)) / (
+            top_n * n_docs)
+    same = sum(list(e) == list(a) for e, a in zip(exact, approx))
+    entries = sum(len(c) for c in counts) / n_docs
+    fixed = settings.SKETCH_WIDTH * settings.SKETCH_DEPTH + settings.HEAVY_HITTERS
+
+    verb('benchSketch', '%d documents, %d ngrams, %d heavy hitters' % (n_docs,
+        sum(sketch.getTotal() for sketch in sketches), settings.HEAVY_HITTERS))
+    verb('benchSketch', 'exact:  %.3fs, %.0f counts per document, %.1f MB '
+            'peak' % (t_exact, entries, peak_exact / (1 << 20)))
+    verb('benchSketch', 'sketch: %.3fs, %d counts per document, %.1f MB '
+            'peak' % (t_sketch, fixed, peak_sketch / (1 << 20)))
+    verb('benchSketch', 'top-%d recall %.3f, %d of %d identical, heavy hitter '
+            'counts over by at most %d' % (top_n, recall, same, n_docs,
+                max_error))
+
+benchmarks = {
+    'code' : benchCodeParser,
+    'dex' : benchDexParser,
+    'leb128' : benchLeb128,
+    'extract' : benchExtract,
+    'multidex' : benchMultidex,
+    'ngrams' : benchNgrams,
+    'sweep' : benchSweep,
+    'opngrams' : benchOpcodeNgrams,
+    'tfidf' : benchTfidf,
+    'sketch' : benchSketch,
+}
+
+if __name__ == '__main__':
+
+    import sys
+
+    settings.VERBOSE = True
+
+    if len(sys.argv) < 2 or sys.argv[1] not in benchmarks:
+        error(sys.argv[0], '%s {%s} <args...>' % (sys.argv[0],
+            '|'.join(benchmarks)), fatal=True, pre='usage')
+
+    benchmarks[sys.argv[1]](*sys.argv[2:])
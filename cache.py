@@ -0,0 +1,325 @@
+#!/usr/bin/python3
+#
+# cache.py: persistent feature cache keyed by APK content hash
+#
+# For documentation on the sqlite3 module, see:
+# https://docs.python.org/3/library/sqlite3.html
+#
+
+import array
+import hashlib
+from message import *
+import os
+import sqlite3
+import time
+
+# Bump when feature extraction changes so stale entries are recomputed
+# History: 1 single-dex features, 2 packed ngram ids, 3 every classes*.dex
+# merged (bumped late: version 1 entries may hold classes.dex alone), 4
+# payloads not counted in opcode histograms
+CACHE_VERSION = 4
+
+# Return the SHA-256 hex digest of a file
+def fileHash(path, block_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+# Return the key of a method body (DexCode.insns) in the MethodCache
+def codeHash(insns):
+    return hashlib.blake2b(insns, digest_size=16).digest()
+
+# Pack a list of integers into a blob of unsigned 64-bit integers
+def packInts(values):
+    return array.array('Q', values).tobytes()
+
+# Unpack a blob created by packInts
+def unpackInts(blob):
+    values = array.array('Q')
+    values.frombytes(blob)
+    return values
+
+# Pack ngram ids into a blob of n-byte ngrams
+def packNgrams(ids, n):
+    return b''.join(i.to_bytes(n, 'little') for i in ids)
+
+# Unpack a blob created by packNgrams into a list of ngram ids
+def unpackNgrams(blob, n):
+    return [ int.from_bytes(blob[i:i+n], 'little') for i in
+            range(0, len(blob), n) ]
+
+# Object for storing per-APK features in an SQLite database
+#
+# Each entry holds the count features of the FeatureVector and the opcode
+# histogram, and the raw ngram counts (keys concatenated, counts packed) of
+# every ngram length counted for the APK, side by side, so TF-IDF features
+# can be recomputed for any corpus and any of those lengths without
+# re-extraction. Opcode ngrams are kept in a table of their own. An entry is
+# only a hit if it has the ngrams of apk.ngram_size and of every length in
+# sweep, and its opcode ngrams if opcodes is set.
+# Entries are keyed by the extraction backend too, since string ngrams are
+# read from resources.arsc with the zip backend and from strings.xml with
+# apktool, so the entries of each backend are kept side by side.
+class FeatureCache:
+
+    # Tables holding entries
+    TABLES = ('features', 'ngrams', 'op_ngrams')
+
+    def __init__(self, path, backend, sweep=(), opcodes=False):
+
+        self.path = path
+        self.backend = backend  # Extraction backend (settings.EXTRACT_BACKEND)
+        self.sweep = sweep
+        self.opcodes = opcodes
+        self.hits = 0
+        self.misses = 0
+
+        self.db = sqlite3.connect(path)
+        self.dropUnkeyed()
+        self.db.execute('''CREATE TABLE IF NOT EXISTS features (
+            sha256 TEXT,
+            backend TEXT,
+            version INTEGER,
+            counts BLOB,
+            opcodes BLOB,
+            PRIMARY KEY (sha256, backend)
+        )''')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS ngrams (
+            sha256 TEXT,
+            backend TEXT,
+            version INTEGER,
+            ngram_size INTEGER,
+            ngram_keys BLOB,
+            ngram_counts BLOB,
+            PRIMARY KEY (sha256, backend, ngram_size)
+        )''')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS op_ngrams (
+            sha256 TEXT,
+            backend TEXT,
+            version INTEGER,
+            ngram_keys BLOB,
+            ngram_counts BLOB,
+            PRIMARY KEY (sha256, backend)
+        )''')
+
+    # Drop the tables of a cache created before entries were keyed by
+    # backend, since the backend of their entries is unknown
+    def dropUnkeyed(self):
+
+        with self.db:
+            for table in FeatureCache.TABLES:
+                columns = [ row[1] for row in self.db.execute(
+                        'PRAGMA table_info(%s)' % (table)) ]
+                if columns and 'backend' not in columns:
+                    warn('FeatureCache', 'dropping %s of %s, its entries are '
+                            'not keyed by backend' % (table, self.path))
+                    self.db.execute('DROP TABLE %s' % (table))
+
+    # Load cached features into apk (an ApkAnalyzer with apk.sha256 set)
+    # Returns True on a cache hit
+    def get(self, apk):
+
+        key = (apk.sha256, self.backend, CACHE_VERSION)
+        row = self.db.execute('''SELECT counts, opcodes FROM features WHERE
+            sha256 = ? AND backend = ? AND version = ?''', key).fetchone()
+        sizes = { n for n, in self.db.execute('''SELECT ngram_size FROM
+            ngrams WHERE sha256 = ? AND backend = ? AND version = ?''', key) }
+
+        op_row = None
+        if self.opcodes:
+            op_row = self.db.execute('''SELECT ngram_keys, ngram_counts FROM
+                op_ngrams WHERE sha256 = ? AND backend = ? AND version = ?''',
+                key).fetchone()
+
+        if (row is None or not sizes.issuperset((apk.ngram_size, *self.sweep))
+                or (self.opcodes and op_row is None)):
+            self.misses += 1
+            return False
+
+        counts, opcodes = row
+        keys, ngram_counts = self.db.execute('''SELECT ngram_keys,
+            ngram_counts FROM ngrams WHERE sha256 = ? AND backend = ? AND
+            ngram_size = ?''', (apk.sha256, self.backend,
+                apk.ngram_size)).fetchone()
+
+        n = apk.ngram_size
+        apk.vector.setCounts(unpackInts(counts))
+        apk.vector.opcodes = array.array('L', unpackInts(opcodes))
+        apk.ngrams = dict(zip(unpackNgrams(keys, n), unpackInts(ngram_counts)))
+        if op_row is not None:
+            apk.op_ngrams = tuple(unpackInts(blob) for blob in op_row)
+        apk.finished = True
+
+        self.hits += 1
+        return True
+
+    # Store the features of a finished apk, with its ngrams of
+    # apk.ngram_size, those in apk.sweep_ngrams and its opcode ngrams
+    def put(self, apk):
+
+        if apk.ngrams is None:
+            # Compacted by ApkAnalyzer.compact
+            ids = apk.ngram_ids
+            counts = apk.ngram_counts
+        else:
+            ids = list(apk.ngrams)
+            counts = apk.ngrams.values()
+
+        ngrams = [ (apk.ngram_size, ids, counts) ]
+        ngrams += [ (n, *sweep) for n, sweep in apk.sweep_ngrams.items() ]
+
+        with self.db:
+            self.db.execute('''INSERT OR REPLACE INTO features (sha256,
+                backend, version, counts, opcodes) VALUES (?,?,?,?,?)''', (
+                    apk.sha256, self.backend, CACHE_VERSION,
+                    packInts(apk.vector.getCounts()),
+                    packInts(apk.vector.opcodes)))
+            self.db.executemany('''INSERT OR REPLACE INTO ngrams VALUES
+                (?,?,?,?,?,?)''', ((apk.sha256, self.backend, CACHE_VERSION,
+                    n, packNgrams(ids, n), packInts(counts)) for n, ids, counts
+                    in ngrams))
+            if apk.op_ngrams is not None:
+                self.db.execute('''INSERT OR REPLACE INTO op_ngrams VALUES
+                    (?,?,?,?,?)''', (apk.sha256, self.backend, CACHE_VERSION,
+                        *(packInts(a) for a in apk.op_ngrams)))
+
+    # Close the database
+    def close(self):
+
+        verb('FeatureCache', '%d hits, %d misses in %s' % (self.hits,
+            self.misses, self.path))
+        self.db.close()
+
+
+# Object for storing per-method features in an SQLite database shared by all
+# worker processes, keyed by codeHash of the method body
+#
+# Each entry holds the opcode histogram (opcodes and their counts) and the
+# ngram counts of one method body. The least recently used entries are
+# evicted down to `size` entries every time a process has inserted
+# size / EVICT_FRACTION more, so entries are not counted on every insert.
+# The last use of hits is written in batches, with the next insert or every
+# USED_BATCH hits, so lookups do not write to the database.
+# NOTE the last uses not written when a process exits are lost, which only
+# makes eviction less exact
+class MethodCache:
+
+    # Maximum number of keys per SELECT statement
+    BATCH = 500
+
+    # Fraction of size inserted by a process between evictions
+    EVICT_FRACTION = 16
+
+    # Number of hits whose last use is written at once
+    USED_BATCH = 4096
+
+    def __init__(self, path, size):
+
+        self.path = path
+        self.size = size
+        self.pid = os.getpid()
+        self.hits = 0
+        self.misses = 0
+        self.inserted = 0       # Entries inserted since the last eviction
+        self.used = {}          # { key : time } of hits whose last use is not written
+
+        # NOTE WAL lets workers read while another worker is writing
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS methods (
+            key BLOB PRIMARY KEY,
+            version INTEGER,
+            used REAL,
+            ops BLOB,
+            op_counts BLOB,
+            ngram_size INTEGER,
+            ngram_keys BLOB,
+            ngram_counts BLOB
+        )''')
+        self.db.execute('''CREATE INDEX IF NOT EXISTS methods_used ON
+            methods (used)''')
+
+    # Look up method bodies by key, with ngrams of length n
+    # Returns { key : (opcode histogram, ngrams) } for the keys found
+    def get(self, keys, n):
+
+        keys = list(keys)
+        found = {}
+
+        for i in range(0, len(keys), MethodCache.BATCH):
+            batch = keys[i:i+MethodCache.BATCH]
+            rows = self.db.execute('''SELECT key, ops, op_counts, ngram_size,
+                ngram_keys, ngram_counts FROM methods WHERE version = ? AND
+                ngram_size = ? AND key IN (%s)''' % (
+                ','.join('?' * len(batch))), (CACHE_VERSION, n, *batch))
+            for key, ops, op_counts, size, ngram_keys, ngram_counts in rows:
+                hist = dict(zip(ops, unpackInts(op_counts)))
+                ngrams = dict(zip(unpackNgrams(ngram_keys, size),
+                    unpackInts(ngram_counts)))
+                found[key] = (hist, ngrams)
+
+        # Mark entries as recently used
+        self.used.update(dict.fromkeys(found, time.time()))
+        if len(self.used) >= MethodCache.USED_BATCH:
+            with self.db:
+                self.writeUsed()
+
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    # Store { key : (opcode histogram, ngrams of length n) } and evict old
+    # entries
+    def put(self, entries, n):
+
+        if not entries:
+            return
+
+        now = time.time()
+        rows = []
+        for key, (hist, ngrams) in entries.items():
+            rows.append((key, CACHE_VERSION, now, bytes(hist),
+                packInts(hist.values()), n, packNgrams(ngrams, n),
+                packInts(ngrams.values())))
+
+        with self.db:
+            self.db.executemany('''INSERT OR REPLACE INTO methods VALUES
+                (?,?,?,?,?,?,?,?)''', rows)
+            self.writeUsed()
+            self.inserted += len(rows)
+            if self.inserted * MethodCache.EVICT_FRACTION >= self.size:
+                self.evict()
+                self.inserted = 0
+
+    # Write the last use of hits (in a transaction)
+    def writeUsed(self):
+
+        if self.used:
+            self.db.executemany('UPDATE methods SET used = ? WHERE key = ?',
+                    ((t, key) for key, t in self.used.items()))
+            self.used = {}
+
+    # Remove the least recently used entries above self.size (in a
+    # transaction)
+    def evict(self):
+
+        count, = self.db.execute('SELECT COUNT(*) FROM methods').fetchone()
+        if count > self.size:
+            debug('MethodCache', 'evicting %d entries' % (count - self.size))
+            self.db.execute('''DELETE FROM methods WHERE key IN (SELECT key
+                FROM methods ORDER BY used LIMIT ?)''', (count - self.size,))
+
+
+# MethodCache of the current process
+_method_cache = None
+
+# Return the MethodCache of the current process
+# NOTE SQLite connections must not be used across fork(), so pool workers
+# open their own connection
+def methodCache(path, size):
+    global _method_cache
+    if _method_cache is None or _method_cache.pid != os.getpid():
+        _method_cache = MethodCache(path, size)
+    return _method_cache
@@ -3,6 +3,8 @@
 # data.py: library for data structures
 #
 
+import array
+
 # The functions below are for updating occurances in a dictionary
 # dict format: { object : n } where n is the number of occurences of object
 
@@ -26,7 +28,7 @@ class FeatureVector:
 
     # Number of ngrams
     n_ngrams = 5
-    labels = (
+    count_labels = (
         'n_direct_methods',
         'n_virtual_methods',
         'n_abstract_direct_methods',
@@ -39,7 +41,12 @@ class FeatureVector:
         'n_total_unary_operators',
         'n_total_binary_operators',
         'n_total_immediate_constants',
-        *('ngram_%d' % (i) for i in range(n_ngrams))
+    )
+    ngram_labels = tuple('ngram_%d' % (i) for i in range(n_ngrams))
+    op_ngram_labels = tuple('op_ngram_%d' % (i) for i in range(n_ngrams))
+    labels = (
+        *count_labels,
+        *ngram_labels,
     )
 
     # Entries of the feature vector
@@ -56,14 +63,38 @@ class FeatureVector:
     n_total_binary_operators = 0
     n_total_immediate_constants = 0
     top_ngrams = ()
+    top_op_ngrams = ()
 
     def __init__(self, n_ngrams=5):
 
         self.n_ngrams = n_ngrams
 
+        # Number of instructions with each opcode
+        self.opcodes = array.array('L', [0]) * 0x100
+
         # Numeric vector data
         self.vector = ()
 
+    # Return the count features (everything but the ngrams) in label order
+    def getCounts(self):
+        return tuple(getattr(self, name) for name in self.count_labels)
+
+    # Set the count features from values in label order
+    def setCounts(self, values):
+        for name, value in zip(self.count_labels, values):
+            setattr(self, name, value)
+
+    # Add the count features and opcode counts of another FeatureVector
+    def update(self, other):
+        self.setCounts(a + b for a, b in zip(self.getCounts(),
+            other.getCounts()))
+        for op, n in enumerate(other.opcodes):
+            self.opcodes[op] += n
+
+    # Count instructions whose opcodes are set in mask (a 256-entry 0/1 array)
+    def countOpcodes(self, mask):
+        return sum(n for n, m in zip(self.opcodes, mask) if m)
+
     # Generate and return numeric vector
     def get(self):
 
@@ -81,6 +112,7 @@ class FeatureVector:
             self.n_total_binary_operators,
             self.n_total_immediate_constants,
             *self.top_ngrams,
+            *self.top_op_ngrams,
         )
 
         return self.vector
@@ -104,7 +136,12 @@ class FeatureVector:
         #for i in range(len(self.top_ngrams)):
         #    self.labeled_vector['ngram_%d'%(i)] = self.top_ngrams[i]
 
-        self.labeled_vector = { name:val for name,val in zip(self.labels, self.get()) }
+        # NOTE an apk can have fewer than n_ngrams ngrams, so each family is
+        # labeled separately
+        self.get()
+        self.labeled_vector = dict(zip(self.count_labels, self.getCounts()))
+        self.labeled_vector.update(zip(self.ngram_labels, self.top_ngrams))
+        self.labeled_vector.update(zip(self.op_ngram_labels, self.top_op_ngrams))
         return self.labeled_vector
 
     # Nice string representation
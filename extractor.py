@@ -0,0 +1,300 @@
+#!/usr/bin/python3
+#
+# extractor.py: asyncio front end running apktool extractions
+#
+# For documentation on asyncio subprocesses, see:
+# https://docs.python.org/3/library/asyncio-subprocess.html
+#
+
+import asyncio
+from apktoolpool import ApktoolPool
+from collections import deque
+from message import *
+from multiprocessing import Pipe, Process
+from scratch import Scratch
+import settings
+import shutil
+import signal
+import subprocess
+import time
+import zipfile
+
+# Return the command extracting apk_file to directory with apktool and
+# further options
+def apktoolCommand(apk_file, directory, options=()):
+
+    # Flags:
+    #   d   This instructs apktool to decode an APK file
+    #  -f   This deletes the destination directory if it exists
+    #  -s   This prevents apktool from generating source code from classes.dex
+    #  -o   This precedes the desired name of the output directory
+    return ['apktool', 'd', '-f', '-s', *options, '-o', directory, apk_file]
+
+# Return the apktool options skipping the parts of an APK that are not in
+# plan (see analysis.extractionPlan)
+# NOTE apktool cannot decode strings.xml alone, so with strings all resources
+# are decoded
+def apktoolOptions(plan):
+
+    if 'all' in plan:
+        return []
+
+    # Flags:
+    #  --no-assets  This prevents apktool from copying assets/
+    #  --no-res     This prevents apktool from decoding resources
+    options = ['--no-assets']
+    if 'strings' not in plan:
+        options.append('--no-res')
+    return options
+
+# Return an estimate of the bytes apktool writes extracting apk_file with
+# options (see apktoolOptions): the uncompressed size of the entries it
+# copies or decodes, not counting the growth of decoded resources
+def apktoolSize(apk_file, options=()):
+
+    try:
+        with zipfile.ZipFile(apk_file) as apk:
+            infos = apk.infolist()
+    except (zipfile.BadZipFile, OSError):
+        return 0
+    if '--no-assets' in options:
+        infos = [ info for info in infos if not
+                info.filename.startswith('assets/') ]
+    return sum(info.file_size for info in infos)
+
+# Object for extracting APKs with apktool ahead of the processes parsing them
+#
+# An event loop in a process of its own keeps up to `concurrency` apktool
+# processes running, so no parsing process waits on the JVM. The task of
+# every extracted APK is sent through a pipe to a Scheduler, which receives
+# it when a worker is idle and acknowledges it. At most `backlog` extracted
+# tasks wait unacknowledged, so extraction stops running ahead of parsing
+# (and filling the disk) when parsing is the bottleneck.
+# With a Scratch, extraction also waits for the budget of the scratch
+# directory, and every task is sent with the bytes it holds appended. Those
+# are released by whoever removes its directory.
+# With persistent set, apktool runs in an ApktoolPool of `concurrency`
+# long-lived processes instead of once per APK.
+# NOTE the event loop does not run in a thread, since processes forked by the
+# Scheduler while a thread starts apktool inherit its exec error pipe and
+# block it
+class Extractor:
+
+    # Seconds between checks of a stopping extraction
+    POLL = 0.1
+
+    # Seconds a finished extraction is given to send its failures and
+    # statistics before it is stopped
+    STOP_TIMEOUT = 5
+
+    def __init__(self, jobs, concurrency, backlog, timeout=None, options=(),
+            persistent=False, scratch=None):
+
+        self.jobs = jobs                # (task, apk file, directory) in extraction order
+        self.concurrency = concurrency  # Number of apktool processes
+        self.backlog = backlog          # Number of extracted tasks waiting
+        self.timeout = timeout          # Seconds per extraction (None for no limit)
+        self.options = options          # Further apktool options (see apktoolOptions)
+        self.persistent = persistent    # Whether apktool runs in an ApktoolPool
+        self.scratch = scratch          # Scratch holding the directories (None for no budget)
+        self.pool = None
+        self.failed = []                # (task, reason) of failed extractions
+        self.sent = deque()             # (task, directory, bytes) of unacknowledged tasks
+        self.done = set()               # Tasks sent or failed
+        self.extracted = 0              # Number of APKs extracted
+        self.busy = 0.0                 # Seconds spent in apktool
+        self.blocked = 0.0              # Seconds extraction waited on the backlog and budget
+        self.conn = None                # Extraction end of the pipe
+        self.feed = None                # Scheduler end of the pipe
+        self.process = None
+
+    # Start extracting and return the Connection receiving extracted tasks
+    def start(self):
+
+        self.feed, self.conn = Pipe()
+        self.process = Process(target=self.runLoop, daemon=True)
+        self.process.start()
+        self.conn.close()
+        return self.feed
+
+    # Run the event loop until extraction is done or stopped, then send None
+    # and the failures and statistics (extraction process)
+    # Jobs that were not extracted when extraction stopped are failed. If it
+    # was stopped by SIGTERM, the tasks that were not acknowledged are failed
+    # too and their directories are removed, since they will not be run.
+    def runLoop(self):
+
+        self.feed.close()
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        reason = None
+        try:
+            asyncio.run(self.extractAll())
+        except (asyncio.CancelledError, KeyboardInterrupt):
+            reason = 'extraction stopped'
+            for task, directory, size in self.sent:
+                self.remove(directory, size)
+                self.failed.append((task, reason))
+        except Exception as e:
+            reason = 'extraction stopped: %s' % (e)
+            error('Extractor', reason)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+        if reason is not None:
+            self.failed += [ (task, reason) for task, apk_file, directory in
+                    self.jobs if task not in self.done ]
+
+        # The Scheduler receives every task sent before None
+        try:
+            self.conn.send(None)
+            self.conn.send({ 'failed' : self.failed, 'extracted' :
+                    self.extracted, 'busy' : self.busy, 'blocked' :
+                    self.blocked })
+        except OSError:
+            pass
+
+    # Stop extraction after waiting up to timeout seconds for it to finish,
+    # killing running apktool processes and removing the directories of tasks
+    # that were not acknowledged, and read its failures and statistics
+    def stop(self, timeout=0):
+
+        if self.process is None:
+            return
+
+        deadline = time.monotonic() + timeout
+        try:
+            while True:
+                if self.process.is_alive() and time.monotonic() >= deadline:
+                    self.process.terminate()
+                    deadline = float('inf')
+                if self.feed.poll(Extractor.POLL):
+                    message = self.feed.recv()
+                    if isinstance(message, dict):
+                        vars(self).update(message)
+        except (EOFError, OSError):
+            pass
+        self.process.join()
+        self.process = None
+        self.feed.close()
+
+        verb('Extractor', '%d extracted, %d failed, %.1f s in apktool, '
+                '%.1f s waiting for parsers' % (self.extracted,
+                len(self.failed), self.busy, self.blocked))
+
+    # Extract all jobs
+    async def extractAll(self):
+
+        ready = asyncio.Semaphore(self.backlog)
+        running = asyncio.Semaphore(self.concurrency)
+        loop = asyncio.get_running_loop()
+        loop.add_reader(self.conn.fileno(), self.acknowledge, ready)
+        loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+
+        extractions = []
+        try:
+            if self.persistent:
+                self.pool = ApktoolPool(self.concurrency, self.timeout,
+                        settings.APKTOOL_SERVER_REQUESTS)
+                await self.pool.start()
+
+            for task, apk_file, directory in self.jobs:
+                start = time.monotonic()
+                await ready.acquire()
+                size = await self.reserve(apk_file)
+                self.blocked += time.monotonic() - start
+                await running.acquire()
+                extractions.append(asyncio.create_task(self.extractOne(task,
+                        apk_file, directory, size, running, ready)))
+            await asyncio.gather(*extractions)
+        finally:
+            for extraction in extractions:
+                extraction.cancel()
+            await asyncio.gather(*extractions, return_exceptions=True)
+            loop.remove_reader(self.conn.fileno())
+            if self.pool is not None:
+                await self.pool.close()
+
+    # Receive an acknowledgement of a sent task
+    def acknowledge(self, ready):
+
+        try:
+            self.conn.recv()
+        except (EOFError, OSError):
+            asyncio.get_running_loop().remove_reader(self.conn.fileno())
+            return
+        self.sent.popleft()
+        ready.release()
+
+    # Reserve the estimated size of apk_file in the scratch directory,
+    # waiting for the budget, and return it
+    async def reserve(self, apk_file):
+
+        if self.scratch is None:
+            return 0
+        size = apktoolSize(apk_file, self.options)
+        while not self.scratch.reserve(size):
+            await asyncio.sleep(Scratch.POLL)
+        return size
+
+    # Remove an extracted directory holding size bytes
+    def remove(self, directory, size):
+
+        if self.scratch is None:
+            shutil.rmtree(directory, ignore_errors=True)
+        else:
+            self.scratch.remove(directory, size)
+
+    # Extract one APK for which size bytes are reserved and send its task, or
+    # record why it failed
+    async def extractOne(self, task, apk_file, directory, size, running,
+            ready):
+
+        try:
+            start = time.monotonic()
+            try:
+                reason = await self.extract(apk_file, directory)
+            except Exception as e:
+                reason = '%s: %s' % (type(e).__name__, e)
+            self.busy += time.monotonic() - start
+        except BaseException:
+            self.remove(directory, size)
+            raise
+        finally:
+            running.release()
+
+        if reason is None:
+            if self.scratch is not None:
+                size = self.scratch.adjust(directory, size)
+            self.extracted += 1
+            self.sent.append((task, directory, size))
+            self.done.add(task)
+            self.conn.send(task + (size,))
+        else:
+            error('Extractor', 'cannot extract %s: %s' % (apk_file, reason))
+            self.failed.append((task, reason))
+            self.done.add(task)
+            self.remove(directory, size)
+            ready.release()
+
+    # Run apktool on apk_file and return why it failed (None if it did not)
+    async def extract(self, apk_file, directory):
+
+        verb('extract', 'extracting %s to %s ...' % (apk_file, directory))
+        if self.pool is not None:
+            return await self.pool.extract(apk_file, directory, self.options)
+
+        proc = await asyncio.create_subprocess_exec(*apktoolCommand(apk_file,
+                directory, self.options), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        try:
+            stderr = (await asyncio.wait_for(proc.communicate(),
+                    self.timeout))[1]
+        except asyncio.TimeoutError:
+            return 'apktool timed out after %d s' % (self.timeout)
+        finally:
+            if proc.returncode is None:
+                proc.kill()
+                await asyncio.shield(proc.wait())
+
+        if proc.returncode != 0:
+            return 'apktool exited with code %d\n%s' % (proc.returncode,
+                    stderr.decode())
+        return None
@@ -0,0 +1,110 @@
+#!/usr/bin/python3
+#
+# journal.py: append-only journal of finished APKs for crash recovery
+#
+
+from message import *
+import os
+import pickle
+import struct
+import time
+import zlib
+
+# Object for an append-only journal of pickled records
+#
+# Every record is its length and CRC-32 followed by its pickle, and is
+# flushed as soon as it is appended, so records survive the process being
+# killed. The file is synced every `sync` seconds, so a crash of the machine
+# loses at most that much. The first record is the key of the journal: a
+# journal with another key was written with other settings and is
+# discarded. Replaying stops at the first torn or corrupt record, and the
+# journal is truncated there.
+class Journal:
+
+    # Record header: length and CRC-32 of the pickle
+    HEADER = struct.Struct('<II')
+
+    def __init__(self, path, key, sync=5.0):
+
+        self.path = path
+        self.key = key
+        self.sync = sync            # Seconds between syncs
+        self.records = []           # Records replayed from the file
+        self.last_sync = time.monotonic()
+
+        self.file = open(path, 'a+b')
+        self.replay()
+
+    # Read the records of the file and truncate it after the last good one
+    def replay(self):
+
+        self.file.seek(0)
+        records = []
+        end = 0
+        while True:
+            header = self.file.read(Journal.HEADER.size)
+            if len(header) < Journal.HEADER.size:
+                break
+            size, crc = Journal.HEADER.unpack(header)
+            data = self.file.read(size)
+            if len(data) < size or zlib.crc32(data) != crc:
+                break
+            try:
+                records.append(pickle.loads(data))
+            except Exception:
+                break
+            end = self.file.tell()
+
+        size = self.file.seek(0, os.SEEK_END)
+        if end < size:
+            warn('Journal', 'dropping %d bytes of torn records in %s' % (
+                    size - end, self.path))
+
+        if not records or records[0] != self.key:
+            if records:
+                warn('Journal', 'discarding %s written with other settings' %
+                        (self.path))
+            records = []
+            end = 0
+
+        self.file.truncate(end)
+        self.file.seek(end)
+        if not records:
+            self.write(self.key)
+        self.records = records[1:]
+        verb('Journal', '%d records replayed from %s' % (len(self.records),
+                self.path))
+
+    # Write and flush a record
+    def write(self, record):
+
+        data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        self.file.write(Journal.HEADER.pack(len(data), zlib.crc32(data)))
+        self.file.write(data)
+        self.file.flush()
+
+    # Append a record, syncing the file if it is due
+    def append(self, record):
+
+        self.write(record)
+        if time.monotonic() - self.last_sync >= self.sync:
+            self.flush()
+
+    # Sync the file to disk
+    def flush(self):
+
+        os.fsync(self.file.fileno())
+        self.last_sync = time.monotonic()
+
+    def close(self):
+
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
+
+    # Close and delete the journal
+    def remove(self):
+
+        self.close()
+        os.remove(self.path)
@@ -1,19 +1,120 @@
 from bs4 import BeautifulSoup
+import array
+from collections import Counter
 import os
 import settings
+import sys
 from message import *
 
-def get_n_grams(strings, n=3):
+# Number of ngram ids counted at a time
+BATCH = 1 << 20
 
-    dictionary = {}
+# Return { n : array of the ids of all ngrams of length n in strings } for
+# each n in sizes
+# The id of an ngram is its little-endian integer value (as int.from_bytes)
+def get_multi_n_gram_ids(strings, sizes):
+
+    # Each window of bytes is widened to an array item, so ngrams are packed
+    # into integers without a Python loop over the bytes
+    sizes = sorted(sizes, reverse=True)
+    typecode, width = ('I', 4) if sizes[0] <= 4 else ('Q', 8)
+    if sizes[0] > width:
+        raise ValueError('ngrams longer than %d bytes are not supported' % (width))
+
+    ids = { n : array.array(typecode) for n in sizes }
+    for string in strings:
+        m = len(string) - sizes[-1] + 1
+        if m <= 0:
+            continue
+
+        # Windows of the longest ngrams at every position of the shortest,
+        # zero-padded past the end of the string
+        windows = bytearray(width * m)
+        for i in range(min(sizes[0], len(string))):
+            k = min(m, len(string) - i)
+            windows[i:i+width*k:width] = string[i:i+k]
 
+        # Shorten the windows in place, from the longest ngrams down
+        length = sizes[0]
+        for n in sizes:
+            while length > n:
+                length -= 1
+                windows[length::width] = bytes(m)
+            if n == sizes[-1]:
+                ids[n].frombytes(windows)
+            elif len(string) >= n:
+                ids[n].frombytes(windows[:width*(len(string)-n+1)])
+
+    if sys.byteorder == 'big':
+        for a in ids.values():
+            a.byteswap()
+    return ids
+
+# Return an array of the ids of all ngrams in strings
+def get_n_gram_ids(strings, n=3):
+    return get_multi_n_gram_ids(strings, (n,))[n]
+
+# Yield lists of strings of about BATCH bytes, so the id arrays of a batch
+# stay small for large inputs
+def get_batches(strings):
+
+    batch = []
+    size = 0
     for string in strings:
-        for i in range(len(string)-n):
-            get_occurance(dictionary, string[i:i+n])
+        batch.append(string)
+        size += len(string)
+        if size >= BATCH:
+            yield batch
+            batch = []
+            size = 0
+    yield batch
+
+# Yield arrays of the ids of the ngrams in strings, a batch at a time
+def get_n_gram_batches(strings, n=3):
+    for batch in get_batches(strings):
+        yield get_n_gram_ids(batch, n)
+
+# Count the ngrams of every length in sizes in one pass over strings,
+# returns { n : { ngram id : occurrences } in order of first occurrence }
+def get_multi_n_grams(strings, sizes):
+
+    dictionaries = { n : Counter() for n in sizes }
+    for batch in get_batches(strings):
+        for n, ids in get_multi_n_gram_ids(batch, sizes).items():
+            dictionaries[n].update(ids)
+
+    return dictionaries
+
+# Count the ngrams in strings, returns { ngram id : occurrences } in order of
+# first occurrence
+def get_n_grams(strings, n=3):
+    return get_multi_n_grams(strings, (n,))[n]
+
+
+# Count the ngrams of every length in sizes (at most 4) in opcode streams,
+# returns { ngram id : occurrences }
+# The id of an opcode ngram of length n is its little-endian integer value
+# plus n << 32, so ngrams of different lengths have different ids
+def get_opcode_n_grams(streams, sizes=(1, 2, 3, 4)):
+
+    if max(sizes) > 4:
+        raise ValueError('opcode ngrams longer than 4 are not supported')
+
+    dictionary = {}
+    for n, ngrams in get_multi_n_grams(streams, sizes).items():
+        tag = n << 32
+        dictionary.update({ i | tag : count for i, count in ngrams.items() })
 
     return dictionary
 
 
+# Return the (ids, counts) arrays of a { ngram id : occurrences } dictionary
+def get_sparse_n_grams(dictionary):
+    ids = array.array('Q', dictionary)
+    counts = array.array('Q', dictionary.values())
+    return ids, counts
+
+
 # Takes in the tuple as the key and checks the dictionary to see if it is already in there, and if not, it is added
 def get_occurance(dictionary, key):
     if key in dictionary:
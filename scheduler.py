@@ -0,0 +1,345 @@
+#!/usr/bin/python3
+#
+# scheduler.py: process pool with per-task timeouts and memory ceilings
+#
+
+from message import *
+from multiprocessing import Pipe, Process
+from multiprocessing.connection import wait
+import os
+import pickle
+import signal
+import time
+
+# Return the memory available to new processes in bytes (None if unknown)
+def availableMemory():
+
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+# Return the resident memory in bytes of process pid and its descendants
+# (None if it cannot be read)
+def processMemory(pid):
+
+    try:
+        with open('/proc/%d/statm' % (pid)) as f:
+            rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+    try:
+        with open('/proc/%d/task/%d/children' % (pid, pid)) as f:
+            children = [int(i) for i in f.read().split()]
+    except OSError:
+        children = []
+
+    for child in children:
+        rss += processMemory(child) or 0
+    return rss
+
+# Return the number of workers for n_tasks tasks: workers if given, otherwise
+# one per CPU while memory bytes are available for each
+def poolSize(n_tasks, workers=None, memory=None):
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+        available = availableMemory()
+        if memory is not None and available is not None:
+            workers = min(workers, available // memory)
+
+    return max(1, min(workers, n_tasks))
+
+# Run tasks received on conn with func until None is received or the
+# scheduler exits (worker process)
+# NOTE every worker leads its own process group, so the subprocesses of a task
+# (apktool) are killed with it. The scheduler's end of the pipe is closed, so
+# the worker sees end of file if the scheduler is killed
+def work(conn, func, parent):
+
+    os.setpgrp()
+    parent.close()
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        try:
+            result = (True, func(task))
+        except (Exception, SystemExit) as e:
+            result = (False, '%s: %s' % (type(e).__name__, e))
+        conn.send(result)
+
+# Object for a worker process and its throughput statistics
+class Worker:
+
+    def __init__(self, index, func):
+
+        self.index = index
+        self.func = func
+        self.tasks = 0          # Number of tasks finished
+        self.bytes = 0          # Size of the tasks finished
+        self.busy = 0.0         # Seconds spent on tasks
+        self.failures = 0       # Number of tasks failed or killed
+        self.restarts = 0       # Number of times the process was replaced
+        self.sent = 0           # Bytes of pickled tasks sent
+        self.received = 0       # Bytes of pickled results received
+        self.recv_time = 0.0    # CPU seconds spent receiving results
+        self.task = None        # Running task
+        self.size = 0           # Size of the running task
+        self.start = None       # Start time of the running task
+        self.spawn()
+
+    # Start a new worker process
+    def spawn(self):
+
+        self.conn, child = Pipe()
+        self.process = Process(target=work, args=(child, self.func,
+                self.conn), daemon=True)
+        self.process.start()
+        child.close()
+
+    # Send task of the given size to the process
+    def submit(self, task, size):
+
+        self.task = task
+        self.size = size
+        self.start = time.monotonic()
+        data = pickle.dumps(task, pickle.HIGHEST_PROTOCOL)
+        self.sent += len(data)
+        self.conn.send_bytes(data)
+
+    # Receive and return the (ok, result) of the running task
+    def receive(self):
+
+        start = time.process_time()
+        data = self.conn.recv_bytes()
+        self.received += len(data)
+        result = pickle.loads(data)
+        self.recv_time += time.process_time() - start
+        return result
+
+    # Finish the running task and return it
+    def finish(self, ok):
+
+        task = self.task
+        self.busy += time.monotonic() - self.start
+        if ok:
+            self.tasks += 1
+            self.bytes += self.size
+        else:
+            self.failures += 1
+        self.task = None
+        self.start = None
+        return task
+
+    # Kill the process and its process group
+    def kill(self):
+
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except OSError:
+            self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+    # Kill the process and start a new one
+    def restart(self):
+
+        self.kill()
+        self.restarts += 1
+        self.spawn()
+
+    # Stop the process after its running task
+    def stop(self):
+
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(1)
+        if self.process.is_alive():
+            self.kill()
+        else:
+            self.conn.close()
+
+    # Return the elapsed seconds of the running task
+    def elapsed(self):
+
+        return time.monotonic() - self.start
+
+    # Return statistics formatted for output
+    def __format__(self, fmt):
+
+        rate = self.bytes / self.busy / (1 << 20) if self.busy else 0.0
+        return ('worker %d: %d tasks, %d failed, %d restarts, %.1f MB in '
+                '%.1f s busy (%.2f MB/s), IPC %.1f KB sent, %.1f KB '
+                'received' % (self.index, self.tasks, self.failures,
+                self.restarts, self.bytes / (1 << 20), self.busy, rate,
+                self.sent / 1024, self.received / 1024))
+
+# Object for running func over tasks in worker processes
+#
+# Tasks are run largest first, so the longest ones do not start last and
+# leave the other workers idle. A task that runs for more than timeout
+# seconds, or whose worker (with its subprocesses) holds more than memory
+# bytes, is killed with its worker. Killed and failed tasks are recorded in
+# self.failed, and their workers are replaced. If cleanup is given,
+# cleanup(task) is called after every task, whether it finished, failed or
+# was killed, to release what the task holds outside its worker.
+class Scheduler:
+
+    # Seconds between checks of running tasks
+    POLL = 0.5
+
+    def __init__(self, func, workers=None, timeout=None, memory=None,
+            cleanup=None):
+
+        self.func = func
+        self.n_workers = workers    # Number of workers (None to size from CPUs and memory)
+        self.timeout = timeout      # Seconds per task (None for no limit)
+        self.memory = memory        # Bytes per worker (None for no limit)
+        self.cleanup = cleanup      # Called with every task run (None for nothing)
+        self.workers = []
+        self.failed = []            # (task, reason) of failed or killed tasks
+        self.name = str             # Names tasks in messages
+
+    # Run func over tasks and yield the results as they finish
+    # size(task) gives the size of a task for ordering and statistics, and
+    # name(task) names it in messages
+    #
+    # If feed is a Connection, n_feed more tasks arrive through it as they
+    # become ready, ending with None. A task is only received when a worker
+    # is idle, and is acknowledged by sending True back, so the sender can
+    # bound the tasks it holds ready.
+    def run(self, tasks, size=lambda task: 0, name=str, feed=None, n_feed=0):
+
+        pending = sorted(tasks, key=size, reverse=True)
+        n_tasks = len(pending) + (n_feed if feed is not None else 0)
+        if not n_tasks:
+            return
+
+        n_workers = poolSize(n_tasks, self.n_workers, self.memory)
+        verb('Scheduler', 'running %d tasks on %d workers' % (n_tasks,
+                n_workers))
+        self.workers = [Worker(i, self.func) for i in range(n_workers)]
+        self.name = name
+        start = time.monotonic()
+        starved = 0.0
+
+        try:
+            running = 0
+            while pending or running or feed is not None:
+                for worker in self.workers:
+                    if worker.task is None and pending:
+                        task = pending.pop(0)
+                        worker.submit(task, size(task))
+                        running += 1
+
+                conns = [worker.conn for worker in self.workers if
+                        worker.task is not None]
+                if feed is not None and running < len(self.workers):
+                    conns.append(feed)
+                wait_start = time.monotonic()
+                ready = wait(conns, Scheduler.POLL)
+                if not running:
+                    starved += time.monotonic() - wait_start
+
+                if feed in ready:
+                    try:
+                        task = feed.recv()
+                    except EOFError:
+                        task = None
+                    if task is None:
+                        feed = None
+                    else:
+                        try:
+                            feed.send(True)
+                        except OSError:
+                            pass
+                        pending.append(task)
+
+                for worker in self.workers:
+                    if worker.task is None:
+                        continue
+                    if worker.conn in ready:
+                        try:
+                            ok, result = worker.receive()
+                        except (EOFError, OSError):
+                            worker.process.join()
+                            self.fail(worker, 'worker exited with code %s' % (
+                                    worker.process.exitcode))
+                        else:
+                            task = worker.finish(ok)
+                            if self.cleanup is not None:
+                                self.cleanup(task)
+                            if ok:
+                                yield result
+                            else:
+                                self.failed.append((task, result))
+                                error('Scheduler', '%s failed: %s' % (
+                                        name(task), result))
+                        running -= 1
+                    else:
+                        reason = self.check(worker)
+                        if reason is not None:
+                            self.fail(worker, reason)
+                            running -= 1
+        finally:
+            for worker in self.workers:
+                if worker.task is None:
+                    worker.stop()
+                else:
+                    worker.kill()
+            self.report(time.monotonic() - start)
+            if starved:
+                verb('Scheduler', 'all workers waited %.1f s for tasks' % (
+                        starved))
+
+    # Return why the running task of worker must be killed (None if it may
+    # keep running)
+    def check(self, worker):
+
+        if self.timeout is not None and worker.elapsed() > self.timeout:
+            return 'timed out after %d s' % (self.timeout)
+        if self.memory is not None:
+            rss = processMemory(worker.process.pid)
+            if rss is not None and rss > self.memory:
+                return 'exceeded memory ceiling (%d MB)' % (rss >> 20)
+        return None
+
+    # Record the failure of the running task of worker and replace the worker
+    def fail(self, worker, reason):
+
+        task = worker.finish(False)
+        self.failed.append((task, reason))
+        error('Scheduler', 'killed %s: %s' % (self.name(task), reason))
+        worker.restart()
+        if self.cleanup is not None:
+            self.cleanup(task)
+
+    # Print per-worker throughput statistics
+    def report(self, elapsed):
+
+        for worker in self.workers:
+            verb('Scheduler', format(worker))
+        n_bytes = sum(worker.bytes for worker in self.workers)
+        verb('Scheduler', '%d tasks, %d failed, %.1f MB in %.1f s '
+                '(%.2f MB/s)' % (sum(worker.tasks for worker in self.workers),
+                len(self.failed), n_bytes / (1 << 20), elapsed,
+                n_bytes / elapsed / (1 << 20) if elapsed else 0.0))
+        verb('Scheduler', 'IPC: %.1f KB sent, %.1f KB received in %.2f s '
+                'CPU' % (sum(worker.sent for worker in self.workers) / 1024,
+                sum(worker.received for worker in self.workers) / 1024,
+                sum(worker.recv_time for worker in self.workers)))
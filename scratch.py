@@ -0,0 +1,143 @@
+#!/usr/bin/python3
+#
+# scratch.py: per-run scratch directory for extracted APKs, with a byte budget
+#
+
+import hashlib
+from message import *
+from multiprocessing import RLock, Value
+import os
+import re
+import shutil
+import tempfile
+
+# Return the number of bytes in the files under directory
+def treeSize(directory):
+    size = 0
+    for root, dirs, names in os.walk(directory):
+        for name in names:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size
+
+# Return whether a process with the given pid is running on this machine
+def processAlive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+# Object for the scratch directory of a run, where APKs are extracted
+#
+# Every run extracts to a directory of its own under root (a tmpfs such as
+# /dev/shm, or the system default), named after the pid of its process, so
+# runs sharing a corpus do not collide and the corpus volume is never
+# written to. Directories left under root by runs whose process is gone are
+# removed when a Scratch is created.
+#
+# At most `budget` bytes are held at once by all processes: extraction
+# reserves an estimate of the size of an APK, corrects it once extracted,
+# and waits while the reservation would exceed the budget (unless nothing is
+# held, so an APK larger than the budget still runs alone). Removing an
+# extracted directory releases its bytes.
+# NOTE the byte count is shared with the processes started after the Scratch
+# is created, but a Scratch cannot be sent through a pipe
+class Scratch:
+
+    # Prefix of the run directories
+    PREFIX = 'apkset-'
+
+    # Run directories: prefix, pid of the run and a random suffix
+    RUN_DIR = re.compile(r'apkset-(\d+)-\w+$')
+
+    # Seconds between attempts to reserve bytes
+    POLL = 0.1
+
+    def __init__(self, root=None, budget=None):
+
+        if root is not None and not os.path.isdir(root):
+            warn('Scratch', '%s not found, using the system default' % (root))
+            root = None
+
+        self.root = root or tempfile.gettempdir()
+        self.budget = budget            # Bytes held at once (None for no limit)
+        lock = RLock()
+        self.used = Value('q', 0, lock=lock)    # Bytes held
+        self.peak = Value('q', 0, lock=lock)    # Most bytes held at once
+
+        self.removeStale()
+        self.dir = tempfile.mkdtemp(prefix='%s%d-' % (Scratch.PREFIX,
+                os.getpid()), dir=self.root)
+        verb('Scratch', 'extracting to %s' % (self.dir))
+
+    # Remove the directories of runs that are not running any more
+    def removeStale(self):
+
+        try:
+            names = os.listdir(self.root)
+        except OSError:
+            return
+        for name in names:
+            match = Scratch.RUN_DIR.match(name)
+            if match is not None and not processAlive(int(match.group(1))):
+                path = os.path.join(self.root, name)
+                warn('Scratch', 'removing stale %s' % (path))
+                shutil.rmtree(path, ignore_errors=True)
+
+    # Return the directory apk_file is extracted to
+    def path(self, apk_file):
+
+        digest = hashlib.sha1(os.path.abspath(apk_file).encode()).hexdigest()
+        return os.path.join(self.dir, '%s-%s.dec' % (
+                os.path.basename(apk_file), digest[:12]))
+
+    # Reserve size bytes and return whether they fit in the budget (without
+    # waiting)
+    def reserve(self, size):
+
+        with self.used.get_lock():
+            used = self.used.value
+            if (self.budget is not None and used > 0 and
+                    used + size > self.budget):
+                return False
+            self.used.value = used + size
+            self.peak.value = max(self.peak.value, used + size)
+        return True
+
+    # Replace the reservation of directory by the bytes it holds and return
+    # them
+    def adjust(self, directory, reserved):
+
+        size = treeSize(directory)
+        with self.used.get_lock():
+            self.used.value += size - reserved
+            self.peak.value = max(self.peak.value, self.used.value)
+        return size
+
+    # Release size bytes
+    def release(self, size):
+
+        with self.used.get_lock():
+            self.used.value -= size
+
+    # Remove an extracted directory holding size bytes
+    def remove(self, directory, size):
+
+        shutil.rmtree(directory, ignore_errors=True)
+        self.release(size)
+
+    # Remove the run directory and everything left in it
+    def close(self):
+
+        if self.dir is None:
+            return
+        shutil.rmtree(self.dir, ignore_errors=True)
+        verb('Scratch', 'peak %.1f MB extracted at once (budget %s)' % (
+                self.peak.value / (1 << 20), 'none' if self.budget is None
+                else '%.1f MB' % (self.budget / (1 << 20))))
+        self.dir = None
@@ -13,7 +13,42 @@ DEBUG = False               # Whether to display debug output
 DEBUG_FILTER = NO_FILTER()  # 'who' filters for debugging
 TRAIN_PERCENTAGE = 0.4      # Percentage for training set
 NAME = sys.argv[0]          # Executable name
-N_THREADS = 17              # Number of execution threads
+N_THREADS = None            # Number of APK worker processes (None to size from CPUs and memory)
+SHARED_RESULTS = True       # Whether APK workers return ngram arrays in shared memory instead of through a pipe
+TASK_TIMEOUT = 600          # Seconds before an APK worker is killed (None for no limit)
+WORKER_MEMORY = 1 << 31     # Bytes an APK worker (with apktool) may hold before it is killed (None for no limit)
 VERBOSE = False             # Whether output is verbose
 PARALLEL = True             # Whether to multithread
+EXTRACT_BACKEND = 'zip'     # APK extraction backend ('zip' or 'apktool')
+EXTRACT_PLAN = True         # Whether extraction skips the parts of an APK no enabled feature reads
+EXTRACT_CONCURRENCY = 4     # Number of apktool processes running ahead of the APK workers
+EXTRACT_BACKLOG = 4         # Number of extracted APKs waiting for an APK worker
+APKTOOL_SERVER = False      # Whether apktool runs in long-lived processes (ApktoolServer.java, PARALLEL only)
+APKTOOL_JAR = 'apktool.jar' # apktool jar for APKTOOL_SERVER
+APKTOOL_SERVER_REQUESTS = 500 # Extractions before an apktool process is restarted (None for no limit)
+SCRATCH_DIR = '/dev/shm'    # Root of the per-run directories APKs are extracted to by apktool (None for the system default)
+SCRATCH_BUDGET = 1 << 30    # Bytes of extracted APKs held in the scratch directory at once (None for no limit)
+DEX_WORKERS = 4             # Number of processes parsing the DEX files of one APK (PARALLEL = False only, APK workers cannot fork)
+DEX_MMAP = True             # Whether to memory-map DEX files instead of reading them
+DEX_LAZY = True             # Whether to parse DEX tables and code on first access
+NGRAM_SIZE = 3              # Length of byte ngrams
+STRING_NGRAMS = True        # Whether ngrams of string resources are counted with those of bytecode
+NGRAM_SWEEP = ()            # Other ngram lengths counted in the same pass and stored in the feature cache
+COUNT_OPCODES = True        # Whether to count opcodes without decoding bytecode
+OPCODE_NGRAMS = False       # Whether to add the top opcode ngrams by TF-IDF to the features (over this run only, even with TFIDF_MODEL)
+OPCODE_NGRAM_SIZES = (1, 2, 3, 4) # Lengths of opcode ngrams (at most 4)
+FEATURE_CACHE = 'features.db' # Feature cache file (None to disable)
+METHOD_CACHE = 'methods.db' # Per-method feature cache file (None to disable)
+METHOD_CACHE_SIZE = 1 << 20 # Maximum number of methods in the method cache
+STREAM = True               # Whether to spill ngrams to disk and compute TF-IDF in a second pass
+JOURNAL = 'apkset.journal' # Journal of finished APKs replayed after a crash (None to disable)
+JOURNAL_SYNC = 5.0          # Seconds between syncs of the journal to disk
+SPILL_DIR = None            # Directory for spill files (None for the system default)
+TFIDF_MODEL = None          # Persisted TF-IDF model file (None for per-run TF-IDF)
+NGRAM_SKETCH = False        # Whether to approximate ngrams by heavy hitters in fixed memory (no feature cache, TF-IDF model or spill)
+SKETCH_WIDTH = 1 << 14      # Counters per row of a Count-Min Sketch (a power of 2)
+SKETCH_DEPTH = 4            # Rows of a Count-Min Sketch
+HEAVY_HITTERS = 1024        # Number of ngrams tracked per APK in sketch mode
+SKETCH_DOC_WIDTH = 1 << 20  # Counters per row of the document frequency sketch of all APKs
+PROFILE = False             # Whether to report per-phase parsing statistics
 
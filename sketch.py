@@ -0,0 +1,219 @@
+#!/usr/bin/python3
+#
+# sketch.py: approximate ngram counting in fixed memory
+#
+# For the Count-Min Sketch and Space-Saving, see:
+# G. Cormode, S. Muthukrishnan. An improved data stream summary: the count-min
+#   sketch and its applications. Journal of Algorithms 55(1), 2005.
+# A. Metwally, D. Agrawal, A. El Abbadi. Efficient computation of frequent and
+#   top-k elements in data streams. ICDT 2005.
+# M. Cafaro, M. Pulimeno, P. Tempesta. A parallel space saving algorithm for
+#   frequent items and the Hurwitz zeta distribution. Information Sciences
+#   329, 2016.
+#
+
+import array
+from collections import Counter
+import heapq
+import math
+from ngrams import get_n_gram_batches
+from operator import add, itemgetter
+import random
+
+# Object for a Count-Min Sketch of ngram counts
+#
+# Every row has `width` counters, and an ngram is counted in one counter per
+# row chosen by a strongly universal hash of its id. The estimate of an ngram
+# is the smallest of its counters, so estimates never undercount, and with
+# probability at least 1 - exp(-depth) they overcount by at most
+# e / width * total.
+class CountMinSketch:
+
+    # Bits of the hash arithmetic (twice the bits of an ngram id)
+    BITS = 128
+
+    def __init__(self, width, depth, seed=0):
+
+        if width <= 0 or width & (width - 1):
+            raise ValueError('sketch width must be a power of 2: %d' % (width))
+
+        self.width = width
+        self.depth = depth
+        self.seed = seed
+        self.total = 0          # Sum of all counts
+
+        self.rows = [ array.array('Q', bytes(8 * width)) for i in
+                range(depth) ]
+
+        # Multiply-add-shift hashes ((a * id + b) mod 2^BITS) >> shift, drawn
+        # from seed so sketches with the same seed can be merged
+        rand = random.Random(seed)
+        self.hashes = [ (rand.getrandbits(self.BITS),
+            rand.getrandbits(self.BITS)) for i in range(depth) ]
+        self.mask = (1 << self.BITS) - 1
+        self.shift = self.BITS - (width.bit_length() - 1)
+
+    # Add counts { ngram id : count }
+    def update(self, counts):
+
+        mask, shift = self.mask, self.shift
+        for row, (a, b) in zip(self.rows, self.hashes):
+            for i, count in counts.items():
+                row[((a * i + b) & mask) >> shift] += count
+        self.total += sum(counts.values())
+
+    # Return the estimated count of ngram id i
+    def estimate(self, i):
+
+        mask, shift = self.mask, self.shift
+        return min(row[((a * i + b) & mask) >> shift] for row, (a, b) in
+                zip(self.rows, self.hashes))
+
+    # Add the counts of another sketch with the same width, depth and seed
+    def merge(self, other):
+
+        if (other.width, other.depth, other.seed) != (self.width, self.depth,
+                self.seed):
+            raise ValueError('cannot merge sketches of different shapes')
+
+        self.rows = [ array.array('Q', map(add, row, other_row)) for
+                row, other_row in zip(self.rows, other.rows) ]
+        self.total += other.total
+
+    # Return the bound on overcounting, which holds for any one estimate with
+    # probability self.confidence()
+    def error(self):
+
+        return math.e / self.width * self.total
+
+    # Return the probability that an estimate is within self.error()
+    def confidence(self):
+
+        return 1 - math.exp(-self.depth)
+
+
+# Object for a Space-Saving summary of the heavy hitters of ngram counts
+#
+# At most k ngrams are monitored. Counts of monitored ngrams are at most floor
+# above their true counts, ngrams that are not monitored occur at most floor
+# times, and floor is at most total / k. So every ngram that occurs more than
+# total / k times is monitored.
+#
+# Counts are merged a batch (or another summary) at a time: an ngram missing
+# from one side is counted with that side's floor, the k largest counts are
+# kept and the largest dropped count becomes the floor (Cafaro et al.). With
+# batches of single ngrams this is the original algorithm.
+class SpaceSaving:
+
+    def __init__(self, k):
+
+        self.k = k
+        self.counts = {}        # Monitored ngrams { ngram id : count }
+        self.floor = 0          # Bound on the error of counts
+        self.total = 0          # Sum of all counts
+
+    # Add exact counts { ngram id : count }
+    def update(self, counts):
+
+        self.add(counts, 0, sum(counts.values()))
+
+    # Merge another summary
+    def merge(self, other):
+
+        self.add(other.counts, other.floor, other.total)
+
+    # Add counts { ngram id : count } of total occurrences, where counts are
+    # at most floor above the true counts and other ngrams occur at most floor
+    # times
+    def add(self, counts, floor, total):
+
+        merged = { i : count + counts.get(i, floor) for i, count in
+                self.counts.items() }
+        for i, count in counts.items():
+            if i not in merged:
+                merged[i] = count + self.floor
+
+        self.floor += floor
+        self.total += total
+
+        if len(merged) > self.k:
+            top = heapq.nlargest(self.k + 1, merged.items(), key=itemgetter(1))
+            self.floor = max(self.floor, top.pop()[1])
+            merged = dict(top)
+        self.counts = merged
+
+
+# Object for approximate ngram counts of one document in fixed memory: a
+# CountMinSketch and a SpaceSaving summary of the same counts
+#
+# Counts are buffered and added to both a batch at a time. The count of a
+# heavy hitter is the smaller of its two estimates, as both only overcount.
+# NOTE sketches are merged with the same seed, so all documents use seed 0
+class NgramSketch:
+
+    # Number of distinct ngrams buffered before they are added
+    BATCH = 1 << 16
+
+    def __init__(self, n, width, depth, k):
+
+        self.n = n              # Length of ngrams
+        self.cms = CountMinSketch(width, depth)
+        self.summary = SpaceSaving(k)
+        self.pending = Counter()
+
+    # Count the ngrams of strings
+    def addStrings(self, strings):
+
+        for ids in get_n_gram_batches(strings, self.n):
+            for i in range(0, len(ids), NgramSketch.BATCH):
+                self.update(ids[i:i+NgramSketch.BATCH])
+
+    # Count ngram ids (an iterable) or add counts { ngram id : count }
+    def update(self, ids):
+
+        self.pending.update(ids)
+        if len(self.pending) >= NgramSketch.BATCH:
+            self.flush()
+
+    # Add the buffered counts to the sketches
+    def flush(self):
+
+        if self.pending:
+            self.cms.update(self.pending)
+            self.summary.update(self.pending)
+            self.pending = Counter()
+
+    # Add the counts of another NgramSketch
+    def merge(self, other):
+
+        self.flush()
+        other.flush()
+        self.cms.merge(other.cms)
+        self.summary.merge(other.summary)
+
+    # Return the number of ngrams counted
+    def getTotal(self):
+
+        self.flush()
+        return self.summary.total
+
+    # Return the estimated counts of the heavy hitters { ngram id : count }
+    def getHeavyHitters(self):
+
+        self.flush()
+        return { i : min(count, self.cms.estimate(i)) for i, count in
+                self.summary.counts.items() }
+
+    # Return (Space-Saving, Count-Min) bounds on the overcounting of the
+    # heavy hitters
+    def getErrors(self):
+
+        self.flush()
+        return self.summary.floor, self.cms.error()
+
+
+# Return { ngram id : estimated number of documents } for the ngram ids of
+# documents, given a CountMinSketch of the documents each ngram occurs in
+# NOTE estimates are at most n_docs
+def getSketchDocFreq(doc_freq, ids, n_docs):
+    return { i : min(doc_freq.estimate(i), n_docs) for i in ids }
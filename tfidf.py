@@ -0,0 +1,377 @@
+#!/usr/bin/python3
+#
+# tfidf.py: sparse document-term matrix and TF-IDF weighting of ngrams
+#
+
+import array
+from cache import packInts, unpackInts
+from collections import Counter
+import heapq
+from itertools import repeat
+import math
+from message import *
+from operator import mul, truediv
+import sqlite3
+
+# Object for a document-term matrix of ngram counts in CSR form
+#
+# Row r (a document) holds the ngram ids indices[indptr[r]:indptr[r+1]] and
+# their counts in data. Ngram ids are used as column indices directly.
+class NgramMatrix:
+
+    def __init__(self):
+
+        self.indptr = array.array('Q', [0])     # Row start offsets
+        self.indices = array.array('Q')         # Ngram ids (columns)
+        self.data = array.array('Q')            # Ngram counts
+
+    # Number of rows
+    def __len__(self):
+
+        return len(self.indptr) - 1
+
+    # Append a row of distinct ngram ids and their counts, returns its index
+    def addRow(self, ids, counts):
+
+        self.indices.extend(ids)
+        self.data.extend(counts)
+        self.indptr.append(len(self.indices))
+        return len(self) - 1
+
+    # Return (ids, counts) of row
+    def row(self, row):
+
+        start, end = self.indptr[row], self.indptr[row + 1]
+        return self.indices[start:end], self.data[start:end]
+
+    # Return { ngram id : number of rows with the ngram } (column counts)
+    def docFreq(self):
+
+        return Counter(self.indices)
+
+
+# Return { ngram id : IDF } from document frequencies of n_docs documents
+def getIdf(doc_freq, n_docs):
+    log_total_docs = math.log(n_docs)
+    return { i : log_total_docs - math.log(df) for i, df in doc_freq.items() }
+
+# Return the TF-IDF values of a row of ngram ids and counts, where total is
+# the number of ngrams of the document (the sum of counts by default)
+# NOTE computed as (count / total) * idf, the same operations in the same
+# order as the original per-ngram loop, so values are identical
+def getTfidf(ids, counts, idf, total=None):
+    if total is None:
+        total = sum(counts)
+    return list(map(mul, map(truediv, counts, repeat(total)),
+        map(idf.__getitem__, ids)))
+
+# Return the top_n ngram ids by value, ties in row order (as a stable sort)
+def getTopNgrams(ids, values, top_n):
+    top = heapq.nlargest(top_n, range(len(values)), key=values.__getitem__)
+    return [ ids[i] for i in top ]
+
+
+# Object for a persisted corpus TF-IDF model (an SQLite database) that keeps
+# document frequencies and the sparse ngram counts of every document, so
+# documents can be added and removed without rebuilding the corpus
+#
+# The TF-IDF of an ngram with count c in a document with total ngram count T
+# is c / T * (log(n_docs) - log(df)). Adding documents raises n_docs and can
+# only raise document frequencies. So each other ngram of a row stays at or
+# below the line of its count with the lowest document frequency it had when
+# the row was ranked. Every row stores its top_n (with their positions, which
+# break ties) and those lines. After adding documents, a row keeps its top_n
+# if they are still in order and every line is below the last of them (or
+# the ngrams of the lines that are not are, with their current document
+# frequencies). Only the other rows are re-ranked. Removing documents lowers
+# document frequencies, so every row is re-ranked.
+#
+# The model stores the key of the settings that shape its ngram ids, and
+# one built with another key is rejected. Every document is stored with the
+# content hash of its file, so a changed file can be found and replaced.
+#
+# NOTE ngram ids must fit in a signed 64-bit integer (ngrams of up to 7 bytes)
+class TfidfModel:
+
+    # Maximum number of keys per statement
+    BATCH = 500
+
+    def __init__(self, path, key, top_n=5):
+
+        self.path = path
+        self.key = repr(key)    # Key of the settings shaping ngram ids
+        self.top_n = top_n
+        self.doc_freq = {}      # Document frequencies read during an update
+        self.reranked = 0       # Rows re-ranked by the last update
+
+        self.db = sqlite3.connect(path)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS docs (
+            name TEXT PRIMARY KEY,
+            sha256 TEXT,
+            ngram_ids BLOB,
+            ngram_counts BLOB,
+            total INTEGER,
+            top BLOB,
+            top_pos BLOB,
+            top_counts BLOB,
+            top_dfs BLOB,
+            line_counts BLOB,
+            line_dfs BLOB,
+            tie INTEGER
+        )''')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS df (
+            ngram INTEGER PRIMARY KEY,
+            n INTEGER
+        )''')
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT)')
+        self.db.execute('CREATE TEMP TABLE ids (ngram INTEGER PRIMARY KEY)')
+        self.checkKey()
+
+    # Store the key in a new model, or check that it is the key of the model
+    # Raises ValueError if it is not
+    def checkKey(self):
+
+        row = self.db.execute('SELECT key FROM meta').fetchone()
+        if row is None and not len(self):
+            with self.db:
+                self.db.execute('INSERT INTO meta VALUES (?)', (self.key,))
+        elif row is None or row[0] != self.key:
+            self.db.close()
+            raise ValueError('%s was built with other settings (%s), remove '
+                    'it to rebuild it' % (self.path, row and row[0]))
+
+    # Number of documents
+    def __len__(self):
+
+        return self.db.execute('SELECT COUNT(*) FROM docs').fetchone()[0]
+
+    # Whether document name is in the model
+    def __contains__(self, name):
+
+        return self.db.execute('SELECT 1 FROM docs WHERE name = ?',
+                (name,)).fetchone() is not None
+
+    # Return the top_n ngram ids of document name (None if not in the model)
+    def top(self, name):
+
+        row = self.db.execute('SELECT top FROM docs WHERE name = ?',
+                (name,)).fetchone()
+        return None if row is None else tuple(unpackInts(row[0]))
+
+    # Return { name : content hash } of all documents
+    def hashes(self):
+
+        return dict(self.db.execute('SELECT name, sha256 FROM docs'))
+
+    # Return { name : top_n ngram ids } of all documents
+    def tops(self):
+
+        return { name : tuple(unpackInts(top)) for name, top in
+                self.db.execute('SELECT name, top FROM docs') }
+
+    # Return { ngram id : document frequency } for ids
+    def getDocFreq(self, ids):
+
+        missing = [ i for i in set(ids) if i not in self.doc_freq ]
+        for j in range(0, len(missing), TfidfModel.BATCH):
+            self.db.execute('DELETE FROM temp.ids')
+            self.db.executemany('INSERT INTO temp.ids VALUES (?)',
+                    ((i,) for i in missing[j:j+TfidfModel.BATCH]))
+            self.doc_freq.update(self.db.execute('''SELECT df.ngram, df.n
+                FROM df JOIN temp.ids ON df.ngram = temp.ids.ngram'''))
+        return self.doc_freq
+
+    # Rank the ngrams of document name and store its top_n and the lines
+    # bounding its other ngrams
+    def rank(self, name, ids, counts, n_docs):
+
+        doc_freq = self.doc_freq
+        dfs = [ doc_freq[i] for i in ids ]
+        idf = getIdf(dict(zip(ids, dfs)), n_docs)
+        values = getTfidf(ids, counts, idf)
+        top = heapq.nlargest(self.top_n, range(len(values)),
+                key=values.__getitem__)
+
+        # Lowest document frequency of the other ngrams for every count
+        # Ngrams on the line of the last of the top_n tie with it, but come
+        # after it, so they are kept apart
+        last = (counts[top[-1]], dfs[top[-1]]) if top else None
+        lines = {}
+        tie = False
+        in_top = set(top)
+        for pos, line in enumerate(zip(counts, dfs)):
+            if pos in in_top:
+                continue
+            if line == last:
+                tie = True
+                continue
+            count, df = line
+            if count not in lines or df < lines[count]:
+                lines[count] = df
+
+        self.db.execute('''UPDATE docs SET top = ?, top_pos = ?, top_counts = ?,
+            top_dfs = ?, line_counts = ?, line_dfs = ?, tie = ? WHERE
+            name = ?''', (packInts(ids[i] for i in top), packInts(top),
+                packInts(counts[i] for i in top), packInts(dfs[i] for i in top),
+                packInts(lines), packInts(lines.values()), tie, name))
+        self.reranked += 1
+
+    # Re-rank document name from its stored ngram counts
+    def rerank(self, name, n_docs):
+
+        ids, counts = self.db.execute('''SELECT ngram_ids, ngram_counts FROM
+            docs WHERE name = ?''', (name,)).fetchone()
+        ids, counts = unpackInts(ids), unpackInts(counts)
+        self.getDocFreq(ids)
+        self.rank(name, ids, counts, n_docs)
+
+    # Delete document name and decrement the document frequencies of its
+    # ngrams, returns False if name is not in the model
+    def delete(self, name):
+
+        row = self.db.execute('SELECT ngram_ids FROM docs WHERE name = ?',
+                (name,)).fetchone()
+        if row is None:
+            return False
+
+        self.db.executemany('UPDATE df SET n = n - 1 WHERE ngram = ?',
+                ((i,) for i in unpackInts(row[0])))
+        self.db.execute('DELETE FROM docs WHERE name = ?', (name,))
+        return True
+
+    # Add documents, an iterable of (name, content hash, ngram ids, ngram
+    # counts)
+    # Documents that are already in the model are replaced
+    # NOTE documents are stored as they are read, so docs can be a generator
+    # over more documents than fit in memory
+    def add(self, docs):
+
+        self.doc_freq = {}
+        old_docs = len(self)
+        added = {}              # Names of added documents (in order)
+        replaced = False
+
+        with self.db:
+            for name, sha256, ids, counts in docs:
+                if name in added:
+                    warn('TfidfModel', 'duplicate document %s' % (name))
+                    continue
+                if self.delete(name):
+                    old_docs -= 1
+                    replaced = True
+
+                self.db.execute('''INSERT INTO docs (name, sha256, ngram_ids,
+                    ngram_counts, total) VALUES (?,?,?,?,?)''', (name, sha256,
+                        packInts(ids), packInts(counts), sum(counts)))
+                self.db.executemany('''INSERT INTO df VALUES (?, 1)
+                    ON CONFLICT (ngram) DO UPDATE SET n = n + 1''',
+                    ((i,) for i in ids))
+                added[name] = True
+            self.db.execute('DELETE FROM df WHERE n = 0')
+
+            n_docs = old_docs + len(added)
+            for name in added:
+                self.rerank(name, n_docs)
+
+            # Replaced documents lower document frequencies, so every row
+            # has to be re-ranked
+            self.reranked = 0
+            if replaced:
+                self.rerankAll(n_docs, added)
+            elif old_docs > 0 and added:
+                self.update(n_docs, added)
+
+        verb('TfidfModel', 'added %d documents, re-ranked %d of %d others' %
+                (len(added), self.reranked, old_docs))
+
+    # Check the top_n of the documents not in added after adding documents,
+    # and re-rank those whose top_n may have changed
+    def update(self, n_docs, added):
+
+        log_total_docs = math.log(n_docs)
+
+        rows = [ row for row in self.db.execute('''SELECT name, total, top,
+            top_pos, top_counts, top_dfs, line_counts, line_dfs, tie FROM
+            docs''') if row[0] not in added ]
+
+        self.getDocFreq(i for row in rows for i in unpackInts(row[2]))
+
+        for (name, total, top, top_pos, top_counts, top_dfs, line_counts,
+                line_dfs, tie) in rows:
+            top, top_pos = unpackInts(top), unpackInts(top_pos)
+            dfs = [ self.doc_freq[i] for i in top ]
+
+            # New TF-IDF of the top_n, computed as in getTfidf
+            values = [ count / total * (log_total_docs - math.log(df)) for
+                    count, df in zip(unpackInts(top_counts), dfs) ]
+            keys = list(zip(values, (-pos for pos in top_pos)))
+
+            # Ngrams tied with the last of the top_n are ahead of it if its
+            # document frequency has changed
+            keep = (all(a > b for a, b in zip(keys, keys[1:])) and
+                    not (tie and dfs[-1] != unpackInts(top_dfs)[-1]))
+
+            # Lines that may be above the last of the top_n are checked with
+            # the current document frequencies of their ngrams
+            # NOTE these are mostly ngrams with large counts that are in most
+            # documents, so there are few of them
+            if keep:
+                lines = { count for count, df in zip(unpackInts(line_counts),
+                    unpackInts(line_dfs)) if not count / total *
+                    (log_total_docs - math.log(df)) < values[-1] }
+                if lines:
+                    keep = self.checkLines(name, lines, total, values[-1],
+                            top_pos, log_total_docs)
+
+            if not keep:
+                self.rerank(name, n_docs)
+
+    # Whether all ngrams of document name with counts in lines (but the
+    # top_n at positions top_pos) come after the last of the top_n, which has
+    # TF-IDF value last
+    def checkLines(self, name, lines, total, last, top_pos, log_total_docs):
+
+        ids, counts = self.db.execute('''SELECT ngram_ids, ngram_counts FROM
+            docs WHERE name = ?''', (name,)).fetchone()
+        ids, counts = unpackInts(ids), unpackInts(counts)
+        in_top = set(top_pos)
+        check = [ pos for pos, count in enumerate(counts) if count in lines and
+                pos not in in_top ]
+        doc_freq = self.getDocFreq(ids[pos] for pos in check)
+
+        for pos in check:
+            value = counts[pos] / total * (log_total_docs -
+                    math.log(doc_freq[ids[pos]]))
+            if value > last or (value == last and pos < top_pos[-1]):
+                return False
+        return True
+
+    # Re-rank all documents but those in skip
+    def rerankAll(self, n_docs, skip=()):
+
+        for name, in self.db.execute('SELECT name FROM docs').fetchall():
+            if name not in skip:
+                self.rerank(name, n_docs)
+
+    # Remove documents by name and re-rank the remaining documents
+    def remove(self, names):
+
+        self.doc_freq = {}
+        self.reranked = 0
+
+        with self.db:
+            for name in names:
+                if not self.delete(name):
+                    warn('TfidfModel', '%s is not in %s' % (name, self.path))
+            self.db.execute('DELETE FROM df WHERE n = 0')
+
+            n_docs = len(self)
+            self.rerankAll(n_docs)
+
+        verb('TfidfModel', 'removed %d documents, re-ranked %d' %
+                (len(names), self.reranked))
+
+    # Close the database
+    def close(self):
+
+        self.db.close()
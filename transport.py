@@ -0,0 +1,104 @@
+#!/usr/bin/python3
+#
+# transport.py: moving result arrays between processes in shared memory
+#
+# For documentation on the shared_memory module, see:
+# https://docs.python.org/3/library/multiprocessing.shared_memory.html
+#
+
+import array
+from collections import namedtuple
+from multiprocessing import resource_tracker, shared_memory
+
+# Placeholder of an array moved to a shared memory segment
+SharedArray = namedtuple('SharedArray', ('offset', 'typecode', 'length'))
+
+# Return value with every array in it (directly or in plain tuples, lists and
+# dict values) replaced by func(array)
+def mapArrays(value, func):
+
+    if isinstance(value, array.array):
+        return func(value)
+    if type(value) in (tuple, list):
+        return type(value)(mapArrays(v, func) for v in value)
+    if isinstance(value, dict):
+        return { k : mapArrays(v, func) for k, v in value.items() }
+    return value
+
+# Start the resource tracker of this process before it starts the processes
+# that call share(), so they all use it: it unlinks their segments that were
+# never attached when this process exits, and does not warn about segments
+# that attach() unlinked
+def track():
+    resource_tracker.ensure_running()
+
+# Move the arrays in the attributes names of obj to one new shared memory
+# segment and return its size in bytes
+#
+# The arrays are replaced by SharedArray placeholders and obj.shm is set to
+# the name of the segment (None if they hold no arrays), so obj pickles to a
+# few hundred bytes however many ngrams it holds. The segment is left for
+# attach() to unlink.
+def share(obj, names):
+
+    arrays = []
+    size = 0
+
+    def place(a):
+        nonlocal size
+        arrays.append((size, a))
+        shared = SharedArray(size, a.typecode, len(a))
+        size += len(a) * a.itemsize
+        return shared
+
+    shared = { k : mapArrays(getattr(obj, k), place) for k in names }
+    obj.shm = None
+    if size == 0:
+        return 0
+
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    try:
+        for offset, a in arrays:
+            nbytes = len(a) * a.itemsize
+            shm.buf[offset:offset+nbytes] = memoryview(a).cast('B')
+    except BaseException:
+        shm.close()
+        shm.unlink()
+        raise
+
+    vars(obj).update(shared)
+    obj.shm = shm.name
+    shm.close()
+    return size
+
+# Restore the arrays in the attributes names of an obj passed through share(),
+# unlink its segment and return its size in bytes
+def attach(obj, names):
+
+    if getattr(obj, 'shm', None) is None:
+        return 0
+
+    shm = shared_memory.SharedMemory(obj.shm)
+    try:
+        buf = shm.buf
+
+        def restore(value):
+            if isinstance(value, SharedArray):
+                a = array.array(value.typecode)
+                nbytes = value.length * a.itemsize
+                a.frombytes(buf[value.offset:value.offset+nbytes])
+                return a
+            if type(value) in (tuple, list):
+                return type(value)(restore(v) for v in value)
+            if isinstance(value, dict):
+                return { k : restore(v) for k, v in value.items() }
+            return value
+
+        vars(obj).update({ k : restore(getattr(obj, k)) for k in names })
+        del buf
+        size = shm.size
+    finally:
+        shm.close()
+        shm.unlink()
+    obj.shm = None
+    return size